@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""Проверка компактных записей журнала: образцы проходят через настоящий ResultsLog и обратно.
+
+Кодек хранит коды и маски вместо подписей, поэтому всё, что выражается кодами, должно читаться
+ровно в ту же запись, а всё остальное — ложиться строкой-словарём.
+
+    python codec_check.py
+"""
+
+import json
+import logging
+import os
+import sys
+import tempfile
+from typing import List, Optional
+
+import script
+
+
+# -------------------- Образцы --------------------
+def samples() -> List[tuple]:
+    """[(запись, ожидаемая форма строки: True — массив, False — словарь)]."""
+    ratings = list(script.RATINGS)
+    positive = script.BLOCKS["details_positive"]
+    negative = script.BLOCKS["details_negative"]
+    block1 = script.BLOCKS["block1"].options
+    deep_full = {key: script.deep_answer(script.BLOCKS[key], 0b101) for key in script.DEEP_BLOCKS}
+    base = {"user_id": 1, "photo": "photo_1", "city": "Минск", "ts": 1700000000.5}
+    no_ts = {key: value for key, value in base.items() if key != "ts"}
+    return [
+        (dict(base, rating=script.RATINGS[ratings[0]], details=positive.labels(0b11), deep=None), True),
+        (dict(base, rating=script.RATINGS[ratings[-1]], details=negative.labels(0b101), deep=deep_full), True),
+        (dict(base, rating=None, details=[], deep=None), True),
+        # блок 2 пропущен кнопкой «Дальше», блок 4 — не дошли
+        (dict(base, rating=script.RATINGS[ratings[1]], details=[], city="Пинск", city_raw="пинск ",
+              deep={"block1": [], "block2": None, "block3": deep_full["block3"]}), True),
+        # дальше — то, что кодами не выразить: такие записи должны остаться словарями
+        (dict(base, rating=script.RATINGS[ratings[0]], details=["старый вариант"], deep=None), False),
+        # прежний бот писал глубокие ответы в порядке нажатий, бывали и повторы
+        (dict(base, rating=None, details=[], deep={"block1": [block1[3], block1[1]]}), False),
+        (dict(base, rating=None, details=[], deep={"block1": [block1[1], block1[1]]}), False),
+        # старые строки без ts
+        (dict(no_ts, rating=script.RATINGS[ratings[0]], details=[], deep=None), False),
+        (dict(base, rating=None, details=None, deep=None), False),
+    ]
+
+
+# -------------------- Проверка --------------------
+def check(workdir: str) -> List[str]:
+    """Пустой список — всё сходится, иначе — описания расхождений."""
+    failures = []
+    ratings = list(script.RATINGS)
+    negative = script.BLOCKS["details_negative"]
+    base = {"user_id": 2, "photo": "photo_2", "city": "Брест", "ts": 1600000000.0}
+    path = os.path.join(workdir, "check.jsonl")
+    codec_path = os.path.join(workdir, "check.codec.json")
+
+    # прошлая версия словаря: другие подписи оценок и лишний вариант деталей
+    old = script.record_dictionary()
+    old["ratings"] = [label + " (v1)" for label in old["ratings"]]
+    old["details"][0].append("старая деталь")
+    with open(codec_path, "w", encoding="utf-8") as f:
+        json.dump({"1": old}, f, ensure_ascii=False)
+    old_codec = script.RecordCodec(codec_path)
+    old_codec.load()
+    old_codec.version = 1
+    old_entry = dict(base, rating=old["ratings"][0], details=[old["details"][0][0], "старая деталь"], deep=None)
+    legacy = dict(base, rating=script.RATINGS[ratings[2]], details=negative.labels(1), deep=None)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(legacy, ensure_ascii=False) + "\n")
+        f.write(json.dumps(old_codec.encode(old_entry), ensure_ascii=False) + "\n")
+
+    # заново открытый кодек видит, что опрос поменялся, и заводит версию 2
+    cases = samples()
+    log = script.ResultsLog(path, codec=script.RecordCodec(codec_path))
+    log.append_many([entry for entry, _ in cases])
+    log.close()
+    if log.codec.version != 2:
+        failures.append(f"ожидалась версия словаря 2, получена {log.codec.version}")
+
+    expected = [(legacy, False), (old_entry, True), *cases]
+    with open(path, "rb") as f:
+        raw = [json.loads(line) for line in f]
+    got = [entry for _, entry in log.iter_since()]
+    if len(got) != len(expected):
+        failures.append(f"прочитано {len(got)} записей из {len(expected)}")
+    for i, ((entry, compact), record, actual) in enumerate(zip(expected, raw, got)):
+        if actual != entry:
+            failures.append(f"запись {i}: {entry!r} -> {actual!r}")
+        if isinstance(record, list) != compact:
+            failures.append(f"запись {i}: ожидалась строка-{'массив' if compact else 'словарь'}, получено {record!r}")
+    return failures
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    logging.getLogger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory(prefix="codec_check_") as workdir:
+        failures = check(workdir)
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    print("Кодек записей: всё сходится" if not failures else f"Расхождений: {len(failures)}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""Нагрузочный прогон бота: настоящее приложение из script.py против фейкового Bot API.
+
+    python loadtest.py --users 2000 --concurrency 200
+    python loadtest.py --users 500 --max-p99-ms 50 --max-api-calls 40   # как регрессионный гейт
+    python loadtest.py --users 5000 --shards 4                          # через процессы-воркеры
+"""
+
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import script
+
+
+# -------------------- Фейковый Bot API --------------------
+class FakeBotAPI(BaseRequest):
+    """Отвечает на вызовы Bot API локально, как настоящий сервер; считает вызовы по методам."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self._message_ids = itertools.count(1000)
+        self._file_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return 5.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def _message(self, chat_id, **extra) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+            **extra,
+        }
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        name = url.rsplit("/", 1)[-1]
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data is not None else {}
+        chat_id = params.get("chat_id")
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Самцыч", "username": "fake_bot"}
+        elif name == "sendMediaGroup":
+            media = params.get("media") or []
+            if isinstance(media, str):
+                media = json.loads(media)
+            result = []
+            for item in media:
+                file_id = item.get("media", "")
+                if str(file_id).startswith("attach://"):
+                    file_id = f"uploaded_{next(self._file_ids)}"
+                photo = [{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}]
+                result.append(self._message(chat_id, photo=photo))
+        elif name.startswith("send"):
+            result = self._message(chat_id, text=params.get("text", ""))
+        elif name.startswith("edit"):
+            result = self._message(chat_id) if chat_id is not None else True
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+
+# -------------------- Пользователи --------------------
+_update_ids = itertools.count(1)
+_callback_ids = itertools.count(1)
+
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+
+
+def message_payload(uid: int, text: str) -> dict:
+    message = {"message_id": next(_update_ids), "date": int(time.time()),
+               "chat": {"id": uid, "type": "private"}, "from": _user(uid), "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def callback_payload(uid: int, data: str, message_id: int) -> dict:
+    query = {
+        "id": str(next(_callback_ids)), "chat_instance": str(uid), "data": data, "from": _user(uid),
+        "message": {"message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"}, "text": "…"},
+    }
+    return {"update_id": next(_update_ids), "callback_query": query}
+
+
+def message_update(bot, uid: int, text: str) -> Update:
+    return Update.de_json(message_payload(uid, text), bot)
+
+
+def callback_update(bot, uid: int, data: str, message_id: int) -> Update:
+    return Update.de_json(callback_payload(uid, data, message_id), bot)
+
+
+def survey_payloads(uid: int, rng: random.Random) -> List[dict]:
+    return [message_payload(uid, data) if kind == "message" else callback_payload(uid, data, message_id=uid)
+            for kind, data in survey_script(rng)]
+
+
+def survey_script(rng: random.Random) -> List[tuple]:
+    """Случайный, но полный проход опроса: [(тип, данные)]."""
+    steps = [("message", "/start"), ("callback", "menu_rate")]
+    rating = rng.choice(list(script.RATINGS))
+    steps.append(("callback", rating))
+    details = script.BLOCKS["details_positive" if rating in script.POSITIVE_RATINGS else "details_negative"]
+    for idx in rng.sample(range(len(details.options)), rng.randint(0, 3)):
+        steps.append(("callback", script.encode_callback(script.ACTION_TOGGLE, details.code, idx)))
+    steps.append(("callback", details.next_data))
+    city = script.BLOCKS["city"]
+    if rng.random() < 0.1:
+        steps.append(("callback", city.next_data))
+        steps.append(("message", rng.choice(["Пинск", "Витебск", "Лида"])))
+    else:
+        steps.append(("callback", script.encode_callback(script.ACTION_TOGGLE, city.code, rng.randrange(len(city.options)))))
+    if rng.random() < 0.3:
+        steps.append(("callback", "invite_no"))
+        return steps
+    steps.append(("callback", "invite_yes"))
+    for key in script.DEEP_BLOCKS:
+        block = script.BLOCKS[key]
+        if block.multi:
+            for idx in rng.sample(range(len(block.options)), rng.randint(1, 3)):
+                steps.append(("callback", script.encode_callback(script.ACTION_TOGGLE, block.code, idx)))
+            steps.append(("callback", block.next_data))
+        else:
+            steps.append(("callback", script.encode_callback(script.ACTION_TOGGLE, block.code, rng.randrange(len(block.options)))))
+    return steps
+
+
+async def run_user(app, uid: int, rng: random.Random, latencies: List[float]):
+    processor = app.update_processor
+    for kind, data in survey_script(rng):
+        if kind == "message":
+            update = message_update(app.bot, uid, data)
+        else:
+            update = callback_update(app.bot, uid, data, message_id=uid)
+        started = time.perf_counter()
+        # тот же путь, что у апдейтов из очереди приложения: через update processor
+        await processor.process_update(update, app.process_update(update))
+        latencies.append(time.perf_counter() - started)
+
+
+# -------------------- Прогон --------------------
+def rss_kb() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[idx]
+
+
+def configure(workdir: str, admins: int, photos: int):
+    # всё окружение бота — во временном каталоге, чтобы прогон не трогал боевые файлы
+    script.BOT_TOKEN = "123456:FAKE"
+    script.DATA_FILE = os.path.join(workdir, "results.json")
+    script.ADMIN_IDS = list(range(10 ** 9, 10 ** 9 + admins))
+    script.PHOTO_IDS = [f"photo_{i}" for i in range(photos)]
+    script.PHOTO_CATALOGUE_FILE = os.path.join(workdir, "photos.json")
+    script.PHOTO_FILE_ID_CACHE = os.path.join(workdir, "photos.file_ids.json")
+    script.photo_catalogue = script.PhotoCatalogue(script.PHOTO_CATALOGUE_FILE, script.PHOTO_FILE_ID_CACHE)
+
+
+async def run(args) -> dict:
+    api = FakeBotAPI(latency=args.api_latency_ms / 1000)
+    app = script.build_application(request=api, concurrency=args.concurrency)
+    rng = random.Random(args.seed)
+    latencies: List[float] = []
+    gate = asyncio.Semaphore(args.parallel_users)
+
+    async def user(uid: int):
+        async with gate:
+            await run_user(app, uid, random.Random(rng.random()), latencies)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    rss_before = rss_kb()
+    api_before = api.total_calls
+    started = time.perf_counter()
+    await asyncio.gather(*(user(uid) for uid in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+    api_calls = api.total_calls - api_before
+    rss_after = rss_kb()
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+
+    completed = script.result_writer.written
+    latencies.sort()
+    return {
+        "users": args.users,
+        "updates": len(latencies),
+        "completed": completed,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "api_calls": api_calls,
+        "api_calls_per_survey": round(api_calls / completed, 2) if completed else None,
+        "api_calls_by_method": dict(sorted(api.calls.items())),
+        "rss_growth_kb": rss_after - rss_before,
+        "keyboard_edits_saved": script.markup_edits.saved,
+        # честные пользователи не должны упираться в лимиты защиты от флуда
+        "updates_throttled": script.abuse_guard.dropped,
+        # по гистограммам бота: где именно тратится время
+        "handler_p99_ms": {
+            dict(key)["handler"]: round(hist.quantile(0.99) * 1000, 3)
+            for key, hist in script.metrics.histograms.get("handler_duration_seconds", {}).items()
+        },
+    }
+
+
+def run_sharded(args) -> dict:
+    """Тот же сценарий через шардированный запуск: фронт раскладывает апдейты по процессам-воркерам.
+
+    Задержку отдельного апдейта между процессами не меряем — только пропускную способность от первого
+    апдейта до записи последнего ответа агрегатором.
+    """
+    router = script.ShardRouter(args.shards, concurrency=args.concurrency,
+                                request_factory=functools.partial(FakeBotAPI, latency=args.api_latency_ms / 1000))
+    rng = random.Random(args.seed)
+    scripts = [survey_payloads(uid, random.Random(rng.random())) for uid in range(1, args.users + 1)]
+    router.start()
+    started = time.perf_counter()
+    # пользователи идут вперемешку, пачками, как из getUpdates
+    for i in range(0, args.users, args.parallel_users):
+        group = scripts[i:i + args.parallel_users]
+        for steps in itertools.zip_longest(*group):
+            router.dispatch([payload for payload in steps if payload is not None])
+    # ждём, пока агрегатор запишет все ответы (рассылку админам с её лимитами в замер не включаем)
+    log = script.ResultsLog(os.path.splitext(script.DATA_FILE)[0] + ".jsonl")
+    completed = 0
+    while completed < args.users and all(w.is_alive() for w in router.workers):
+        time.sleep(0.05)
+        completed = sum(1 for _ in log)
+    elapsed = time.perf_counter() - started
+    router.stop()
+    completed = sum(1 for _ in log)
+    return {
+        "users": args.users,
+        "shards": args.shards,
+        "updates": router.dispatched,
+        "completed": completed,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(router.dispatched / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def check_gates(report: dict, args) -> List[str]:
+    failures = []
+    if args.max_p99_ms is not None and report.get("p99_ms", 0) > args.max_p99_ms:
+        failures.append(f"p99 {report['p99_ms']} мс > {args.max_p99_ms}")
+    if args.min_throughput is not None and report["throughput_ups"] < args.min_throughput:
+        failures.append(f"throughput {report['throughput_ups']} < {args.min_throughput}")
+    if args.max_api_calls is not None and (report.get("api_calls_per_survey") or 0) > args.max_api_calls:
+        failures.append(f"API-вызовов на опрос {report['api_calls_per_survey']} > {args.max_api_calls}")
+    if args.max_rss_growth_mb is not None and report.get("rss_growth_kb", 0) > args.max_rss_growth_mb * 1024:
+        failures.append(f"рост RSS {report['rss_growth_kb']} КБ > {args.max_rss_growth_mb} МБ")
+    if report["completed"] != args.users:
+        failures.append(f"завершено опросов {report['completed']} из {args.users}")
+    return failures
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота против фейкового Bot API")
+    parser.add_argument("--users", type=int, default=1000, help="сколько пользователей проходят опрос")
+    parser.add_argument("--parallel-users", type=int, default=500, help="сколько пользователей активны одновременно")
+    parser.add_argument("--concurrency", type=int, default=script.UPDATE_CONCURRENCY, help="лимит параллельных апдейтов в боте")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="искусственная задержка ответа Bot API")
+    parser.add_argument("--shards", type=int, default=1, help="больше 1 — прогон через шардированный запуск")
+    parser.add_argument("--admins", type=int, default=1)
+    parser.add_argument("--photos", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="вывести отчёт одной JSON-строкой")
+    parser.add_argument("--max-p99-ms", type=float)
+    parser.add_argument("--min-throughput", type=float)
+    parser.add_argument("--max-api-calls", type=float, help="максимум API-вызовов на завершённый опрос")
+    parser.add_argument("--max-rss-growth-mb", type=float)
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory(prefix="loadtest_") as workdir:
+        configure(workdir, args.admins, args.photos)
+        report = run_sharded(args) if args.shards > 1 else asyncio.run(run(args))
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        for key, value in report.items():
+            print(f"{key:>24}: {value}")
+    failures = check_gates(report, args)
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,51 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import argparse
+import asyncio
+import bisect
+import concurrent.futures
+import csv
+import functools
+import itertools
 import json
 import logging
+import math
+import multiprocessing
 import os
-from typing import List
+import queue
+import random
+import re
+import secrets
+import shutil
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+import warnings
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Iterator, List, NamedTuple, Optional
 from telegram import InputMediaPhoto
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
+from telegram.warnings import PTBUserWarning
 from telegram.ext import (
     ApplicationBuilder,
+    ApplicationHandlerStop,
+    BasePersistence,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
     CommandHandler,
     ConversationHandler,
     ContextTypes,
     MessageHandler,
+    PersistenceInput,
+    TypeHandler,
     filters,
 )
 
@@ -22,6 +53,196 @@ from telegram.ext import (
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# -------------------- Метрики --------------------
+# гистограммы в духе Prometheus; отдаются на /metrics (HTTP) и командой /metrics админам
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# доля событий, которые пишем в лог на INFO (вместо лога на каждое нажатие)
+LOG_SAMPLE_RATE = 0.01
+# /metrics — отдельный слушатель, не публичный webhook; по умолчанию только с этой машины
+METRICS_PORT = None
+METRICS_HOST = "127.0.0.1"
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # приблизительно: линейно внутри бакета
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lo = METRICS_BUCKETS[i - 1] if i else 0.0
+                hi = METRICS_BUCKETS[i] if i < len(METRICS_BUCKETS) else lo * 2 or 1.0
+                return lo + (hi - lo) * (rank - seen) / n
+            seen += n
+        return METRICS_BUCKETS[-1]
+
+
+class Metrics:
+    """Реестр метрик: гистограммы и счётчики с метками, gauge'и — функции, считаемые при выдаче."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.histograms.setdefault(name, {})
+        hist = series.get(key)
+        if hist is None:
+            hist = series[key] = Histogram()
+        hist.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def gauge(self, name: str, func, help_text: str = ""):
+        """func() -> {labels_tuple: value} или число."""
+        self.gauges[name] = func
+        if help_text:
+            self.help[name] = help_text
+
+    @staticmethod
+    def _labels(key, extra=()) -> str:
+        items = list(key) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for name, series in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for key, hist in series.items():
+                cumulative = 0
+                for bound, n in zip(METRICS_BUCKETS, hist.counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{self._labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(key, [('le', '+Inf')])} {hist.count}")
+                lines.append(f"{name}_sum{self._labels(key)} {hist.total:.6f}")
+                lines.append(f"{name}_count{self._labels(key)} {hist.count}")
+        for name, series in sorted(self.counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            for key, value in series.items():
+                lines.append(f"{name}{self._labels(key)} {value}")
+        for name, func in sorted(self.gauges.items()):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            try:
+                value = func()
+            except Exception:
+                logger.exception("Gauge %s не посчитался", name)
+                continue
+            if isinstance(value, dict):
+                for key, v in value.items():
+                    lines.append(f"{name}{self._labels(key)} {v}")
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Короткая сводка для чата: p50/p95/p99 по каждой гистограмме."""
+        lines = []
+        for name, series in sorted(self.histograms.items()):
+            lines.append(name)
+            for key, hist in sorted(series.items(), key=lambda kv: -kv[1].count):
+                label = ",".join(str(v) for _, v in key) or "—"
+                lines.append(
+                    f"  {label}: n={hist.count} p50={hist.quantile(0.5) * 1000:.1f}мс "
+                    f"p95={hist.quantile(0.95) * 1000:.1f}мс p99={hist.quantile(0.99) * 1000:.1f}мс"
+                )
+        return "\n".join(lines) or "Метрик пока нет."
+
+
+metrics = Metrics()
+
+
+def instrument(callback, name: Optional[str] = None):
+    """Оборачивает обработчик: время выполнения в гистограмму, выборочный лог вместо лога на каждое событие."""
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            # штатная остановка цепочки (например, защитой от флуда) — не ошибка
+            raise
+        except Exception:
+            metrics.inc("handler_errors_total", handler=name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe("handler_duration_seconds", elapsed, handler=name)
+            if random.random() < LOG_SAMPLE_RATE:
+                query = getattr(update, "callback_query", None)
+                logger.info("%s: %.1f мс, data=%s", name, elapsed * 1000, query.data if query else None)
+    wrapper.instrumented = True
+    return wrapper
+
+
+def instrument_handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+            instrument_handlers(handler.fallbacks)
+        elif not getattr(handler.callback, "instrumented", False):
+            handler.callback = instrument(handler.callback)
+
+
+class InstrumentedRequest(BaseRequest):
+    """Обёртка над транспортом Bot API: задержка каждого вызова по методу."""
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await self.inner.do_request(url, method, request_data, read_timeout=read_timeout,
+                                               write_timeout=write_timeout, connect_timeout=connect_timeout,
+                                               pool_timeout=pool_timeout)
+        except Exception:
+            metrics.inc("bot_api_errors_total", method=api_method)
+            raise
+        finally:
+            metrics.observe("bot_api_duration_seconds", time.perf_counter() - started, method=api_method)
+
+
 # -------------------- Состояния --------------------
 (
     START_MENU,
@@ -35,6 +256,12 @@ logger = logging.getLogger(__name__)
     DEEP_BLOCK3,
     DEEP_BLOCK4,
 ) = range(10)
+# имена для метрик
+STATE_NAMES = {
+    START_MENU: "start_menu", RATE_PHOTO: "rate_photo", AFTER_RATING: "after_rating",
+    CITY_CHOICE: "city_choice", OTHER_CITY: "other_city", INVITE_DEEP: "invite_deep",
+    DEEP_BLOCK1: "deep_block1", DEEP_BLOCK2: "deep_block2", DEEP_BLOCK3: "deep_block3", DEEP_BLOCK4: "deep_block4",
+}
 
 # ===== DEBUG HANDLER TO GET REAL FILE_ID =====
 async def debug_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -45,79 +272,2663 @@ async def debug_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-# -------------------- Утилиты --------------------
-def load_results() -> List[dict]:
-    if not os.path.exists(DATA_FILE):
-        return []
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return []
+# -------------------- Хранилище результатов --------------------
+# "jsonl" — журнал рядом с DATA_FILE, "sqlite" — база с индексами для выборок
+RESULTS_BACKEND = "jsonl"
+
+# fsync делаем не на каждую запись, а пачками: раз в N записей или раз в T секунд
+FSYNC_BATCH_SIZE = 32
+FSYNC_INTERVAL = 1.0
+
+
+class ResultsStore:
+    """Интерфейс хранилища ответов."""
+
+    def append(self, entry: dict):
+        self.append_many([entry])
+
+    def append_many(self, entries: List[dict]):
+        """Записывает пачку и возвращает курсор — позицию сразу после неё."""
+        raise NotImplementedError
+
+    def iter_since(self, cursor=None) -> Iterator[tuple]:
+        """Пары (курсор, запись) для всех записей после курсора."""
+        raise NotImplementedError
+
+    def sync(self):
+        """Сбрасывает на диск всё дописанное; хранилища с транзакциями делают это сами."""
+
+    def __iter__(self) -> Iterator[dict]:
+        for _, entry in self.iter_since():
+            yield entry
+
+    def close(self):
+        pass
+
+
+# -------------------- Компактные записи --------------------
+# Строка журнала — массив вместо словаря с подписями:
+#   [версия, ts, user_id, photo, оценка, блок деталей, маска деталей, город, маски глубоких блоков | null, (город как ввели)]
+# Оценка и блок — номера (оценка 0 — нет), варианты — битовые маски по словарю вариантов этой версии.
+# Словари всех версий лежат рядом с журналом, поэтому старые записи читаются и после правки SURVEY.
+# Строки-словари (прежний формат или запись, которую не выразить кодами) читаются как есть.
+RECORD_FIELDS = ("user_id", "photo", "rating", "details", "city", "city_raw", "deep", "ts")
+RECORD_REQUIRED = tuple(key for key in RECORD_FIELDS if key != "city_raw")
+
+
+def record_dictionary() -> dict:
+    """Словарь вариантов текущего опроса — то, к чему привязаны коды записи."""
+    details = ("details_positive", "details_negative")
+    return {
+        "ratings": list(RATINGS.values()),
+        "details": [list(BLOCKS[key].options) for key in details],
+        "deep_blocks": list(DEEP_BLOCKS),
+        "deep": [list(BLOCKS[key].options) for key in DEEP_BLOCKS],
+        "deep_multi": [BLOCKS[key].multi for key in DEEP_BLOCKS],
+    }
+
+
+class _CodecTables:
+    """Таблицы одной версии словаря: подпись -> код для записи, код -> подписи для чтения."""
+
+    def __init__(self, dictionary: dict):
+        self.ratings = tuple(dictionary["ratings"])
+        self.rating_codes = {label: i + 1 for i, label in enumerate(self.ratings)}
+        self.details = [tuple(opts) for opts in dictionary["details"]]
+        self.detail_bits = [{label: i for i, label in enumerate(opts)} for opts in self.details]
+        self.deep_blocks = tuple(dictionary["deep_blocks"])
+        self.deep = [tuple(opts) for opts in dictionary["deep"]]
+        self.deep_bits = [{label: i for i, label in enumerate(opts)} for opts in self.deep]
+        self.deep_multi = tuple(dictionary["deep_multi"])
+        # подписи по маске: масок мало, а читаются они при каждом проходе по журналу
+        self._labels = {}
+
+    def labels(self, options: tuple, mask: int) -> list:
+        key = (options, mask)
+        labels = self._labels.get(key)
+        if labels is None:
+            labels = self._labels[key] = tuple(opt for i, opt in enumerate(options) if mask >> i & 1)
+        return list(labels)
+
+
+def _mask(labels, bits: dict) -> Optional[int]:
+    mask = 0
+    for label in labels:
+        bit = bits.get(label)
+        if bit is None:
+            return None
+        mask |= 1 << bit
+    return mask
+
+
+class RecordCodec:
+    """Версионированный кодек записей журнала."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.dictionaries = {}
+        self.version: Optional[int] = None
+        self._tables = {}
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.dictionaries = {int(v): d for v, d in json.load(f).items()}
+        except FileNotFoundError:
+            self.dictionaries = {}
+        current = record_dictionary()
+        for version, dictionary in self.dictionaries.items():
+            if dictionary == current:
+                self.version = version
+                break
+        else:
+            # варианты опроса поменялись — заводим новую версию, старые остаются для чтения
+            self.version = max(self.dictionaries, default=0) + 1
+            self.dictionaries[self.version] = current
+            write_file_atomic(self.path, json.dumps({str(v): d for v, d in self.dictionaries.items()},
+                                                    ensure_ascii=False, separators=(",", ":")))
+            logger.info("Словарь записей: версия %d (%s)", self.version, self.path)
+        self._tables = {}
+
+    def _get_tables(self, version: int) -> _CodecTables:
+        tables = self._tables.get(version)
+        if tables is None:
+            if self.version is None:
+                self.load()
+            tables = self._tables[version] = _CodecTables(self.dictionaries[version])
+        return tables
+
+    def encode(self, entry: dict):
+        """Запись -> массив; если запись не выражается кодами текущей версии — возвращается как есть."""
+        if self.version is None:
+            self.load()
+        t = self._get_tables(self.version)
+        # массив восстанавливает все поля, кроме необязательного city_raw: запись без какого-то из них
+        # (старые строки без ts и т.п.) вернулась бы с лишним ключом — оставляем словарём
+        if any(key not in RECORD_FIELDS for key in entry) or any(key not in entry for key in RECORD_REQUIRED):
+            return entry
+        rating = entry.get("rating")
+        rating_code = t.rating_codes.get(rating, 0) if rating is not None else 0
+        if rating is not None and not rating_code:
+            return entry
+        details = entry["details"]
+        if not isinstance(details, list):
+            return entry
+        # блок деталей выбирается по оценке; но подписи одни и те же могут быть в обоих блоках — проверяем по факту
+        for block in range(len(t.details)):
+            details_mask = _mask(details, t.detail_bits[block])
+            if details_mask is not None and (not details_mask or details == t.labels(t.details[block], details_mask)):
+                break
+        else:
+            return entry
+        deep = entry["deep"]
+        masks = None
+        if deep is not None:
+            if not isinstance(deep, dict) or any(key not in t.deep_blocks for key in deep):
+                return entry
+            masks = []
+            for key, bits, multi in zip(t.deep_blocks, t.deep_bits, t.deep_multi):
+                if key not in deep:
+                    masks.append(None)
+                    continue
+                answer = deep[key]
+                if multi:
+                    if not isinstance(answer, list):
+                        return entry
+                    mask = _mask(answer, bits)
+                    # маска помнит только набор: порядок нажатий (так писали раньше) и повторы она теряет
+                    if mask is None or answer != t.labels(t.deep[len(masks)], mask):
+                        return entry
+                else:
+                    if answer is not None and not isinstance(answer, str):
+                        return entry
+                    mask = _mask([] if answer is None else [answer], bits)
+                    if mask is None:
+                        return entry
+                masks.append(mask)
+        record = [self.version, entry.get("ts"), entry.get("user_id"), entry.get("photo"), rating_code,
+                  block, details_mask, entry.get("city"), masks]
+        if "city_raw" in entry:
+            record.append(entry["city_raw"])
+        # последняя страховка: журнал переписывается без возможности отката, поэтому массив пишем,
+        # только если он читается ровно в ту же запись
+        if self.decode(record) != entry:
+            return entry
+        return record
+
+    def decode(self, record) -> dict:
+        if isinstance(record, dict):
+            return record
+        version, ts, user_id, photo, rating_code, block, details_mask, city, masks = record[:9]
+        t = self._get_tables(version)
+        deep = None
+        if masks is not None:
+            deep = {}
+            for key, options, multi, mask in zip(t.deep_blocks, t.deep, t.deep_multi, masks):
+                if mask is None:
+                    continue
+                labels = t.labels(options, mask)
+                deep[key] = labels if multi else (labels[0] if labels else None)
+        entry = {
+            "user_id": user_id,
+            "photo": photo,
+            "rating": t.ratings[rating_code - 1] if rating_code else None,
+            "details": t.labels(t.details[block], details_mask),
+            "city": city,
+            "deep": deep,
+            "ts": ts,
+        }
+        if len(record) > 9:
+            entry["city_raw"] = record[9]
+        return entry
+
+
+class ResultsLog(ResultsStore):
+    """Append-only журнал ответов: одна JSON-запись на строку (компактная, если задан кодек)."""
+
+    def __init__(self, path: str, legacy_path: Optional[str] = None, codec: Optional[RecordCodec] = None,
+                 fsync_batch: int = FSYNC_BATCH_SIZE, fsync_interval: float = FSYNC_INTERVAL):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.codec = codec
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self._fh = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def open(self):
+        if self._fh is not None:
+            return
+        self._migrate_legacy()
+        self._recover()
+        self._fh = open(self.path, "ab")
+
+    def _migrate_legacy(self):
+        # разовый перенос старого DATA_FILE (JSON-массив) в журнал
+        if not self.legacy_path or os.path.exists(self.path) or not os.path.exists(self.legacy_path):
+            return
+        try:
+            with open(self.legacy_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            logger.exception("Не удалось прочитать %s для миграции", self.legacy_path)
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for entry in data:
+                f.write(self._dumps(entry))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        os.replace(self.legacy_path, self.legacy_path + ".migrated")
+        logger.info("Перенесено %d записей из %s в %s", len(data), self.legacy_path, self.path)
+
+    def _recover(self):
+        # после падения последняя строка может быть недописана — чиним или отрезаем её
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            cut = 0
+            pos = size
+            while pos > 0:
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                idx = f.read(step).rfind(b"\n")
+                if idx != -1:
+                    cut = pos + idx + 1
+                    break
+            f.seek(cut)
+            tail = f.read()
+            try:
+                json.loads(tail)
+            except ValueError:
+                logger.warning("Журнал %s: отрезана недописанная строка (%d байт)", self.path, size - cut)
+                f.truncate(cut)
+            else:
+                # запись целая, потерялся только перевод строки
+                f.write(b"\n")
+
+    def _dumps(self, entry: dict) -> str:
+        record = self.codec.encode(entry) if self.codec is not None else entry
+        return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    def _loads(self, line: bytes) -> dict:
+        record = json.loads(line)
+        return self.codec.decode(record) if self.codec is not None else record
+
+    def append_many(self, entries: List[dict]):
+        self.open()
+        lines = "".join(self._dumps(e) for e in entries)
+        self._fh.write(lines.encode("utf-8"))
+        self._fh.flush()
+        self._unsynced += len(entries)
+        if self._unsynced >= self.fsync_batch or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+        return self._fh.tell()
+
+    def sync(self):
+        if self._fh is None or not self._unsynced:
+            return
+        os.fsync(self._fh.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._fh is None:
+            return
+        self.sync()
+        self._fh.close()
+        self._fh = None
+
+    def compact(self) -> tuple:
+        """Переписывает журнал текущим кодеком (старые строки-словари -> массивы). Бот должен быть остановлен."""
+        self.close()
+        self._migrate_legacy()
+        self._recover()
+        if not os.path.exists(self.path):
+            return 0, 0
+        before = os.path.getsize(self.path)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for entry in self:
+                f.write(self._dumps(entry))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        return before, os.path.getsize(self.path)
+
+    def iter_since(self, cursor=None) -> Iterator[tuple]:
+        # читаем лениво, по одной записи; курсор — смещение в байтах; битые строки пропускаем
+        if self._fh is None:
+            self._migrate_legacy()
+        if not os.path.exists(self.path):
+            return
+        offset = cursor or 0
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    entry = self._loads(line)
+                except (ValueError, LookupError):
+                    logger.warning("Журнал %s: битая строка на смещении %d пропущена", self.path, offset - len(line))
+                    continue
+                yield offset, entry
+
+
+# -------------------- SQLite --------------------
+def open_sqlite(path: str, schema: str) -> sqlite3.Connection:
+    """Одно соединение на процесс (доступ под своим замком у владельца), WAL и схема."""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(schema)
+    return conn
+
+
+class WriteBehind:
+    """Фоновая запись накопленных изменений: одна задача за раз, запись — в потоке.
+
+    Изменения копятся у владельца, write() забирает всё накопленное. Если что-то пришло, пока write()
+    работал, задача делает ещё проход — иначе изменение ждало бы следующего и пропало бы при падении.
+    """
+
+    def __init__(self, write: Callable[[], None], name: str):
+        self.write = write
+        self.name = name
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+
+    def schedule(self):
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._dirty:
+            self._dirty = False
+            # PTB отдаёт изменения пачкой через gather — пишем их одной транзакцией после пачки
+            await asyncio.sleep(0)
+            try:
+                await asyncio.to_thread(self.write)
+            except Exception:
+                logger.exception("Не удалось записать %s", self.name)
+                return
+
+    async def wait(self):
+        if self._task is not None:
+            await self._task
+
+
+class SqliteResultsStore(ResultsStore):
+    """Ответы в SQLite: нормализованная схема, WAL, одно соединение, запись пачками в одной транзакции."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            id INTEGER PRIMARY KEY,
+            ts REAL,
+            user_id INTEGER,
+            photo TEXT,
+            rating TEXT,
+            city TEXT,
+            has_deep INTEGER NOT NULL DEFAULT 0,
+            city_raw TEXT
+        );
+        CREATE TABLE IF NOT EXISTS entry_details (
+            entry_id INTEGER NOT NULL REFERENCES entries(id),
+            option TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS entry_deep (
+            entry_id INTEGER NOT NULL REFERENCES entries(id),
+            block INTEGER NOT NULL,
+            option TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_entries_city ON entries(city);
+        CREATE INDEX IF NOT EXISTS idx_entries_photo ON entries(photo);
+        CREATE INDEX IF NOT EXISTS idx_entries_rating ON entries(rating);
+        CREATE INDEX IF NOT EXISTS idx_entries_ts ON entries(ts);
+        CREATE INDEX IF NOT EXISTS idx_details_entry ON entry_details(entry_id);
+        CREATE INDEX IF NOT EXISTS idx_details_option ON entry_details(option);
+        CREATE INDEX IF NOT EXISTS idx_deep_entry ON entry_deep(entry_id);
+        CREATE INDEX IF NOT EXISTS idx_deep_block_option ON entry_deep(block, option);
+    """
+    READ_CHUNK = 500
+
+    def __init__(self, path: str, import_from: Optional[ResultsStore] = None):
+        self.path = path
+        self.import_from = import_from
+        self._conn: Optional[sqlite3.Connection] = None
+        # соединение одно на процесс: пишет воркер записи, читают админ-команды
+        self._lock = threading.Lock()
+
+    def open(self):
+        if self._conn is not None:
+            return
+        conn = open_sqlite(self.path, self.SCHEMA)
+        # базы до появления city_raw
+        if "city_raw" not in {row[1] for row in conn.execute("PRAGMA table_info(entries)")}:
+            conn.execute("ALTER TABLE entries ADD COLUMN city_raw TEXT")
+        self._conn = conn
+        if self.import_from is not None and conn.execute("SELECT 1 FROM entries LIMIT 1").fetchone() is None:
+            self._import(self.import_from)
+
+    def _import(self, source: ResultsStore):
+        batch = []
+        total = 0
+        for entry in source:
+            batch.append(entry)
+            if len(batch) >= self.READ_CHUNK:
+                self.append_many(batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            self.append_many(batch)
+            total += len(batch)
+        if total:
+            logger.info("Импортировано %d записей в %s", total, self.path)
+
+    def append_many(self, entries: List[dict]):
+        self.open()
+        with self._lock, self._conn:
+            for e in entries:
+                deep = e.get("deep")
+                cur = self._conn.execute(
+                    "INSERT INTO entries (ts, user_id, photo, rating, city, has_deep, city_raw) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (e.get("ts"), e.get("user_id"), e.get("photo"), e.get("rating"), e.get("city"), int(deep is not None),
+                     e.get("city_raw")),
+                )
+                entry_id = cur.lastrowid
+                self._conn.executemany(
+                    "INSERT INTO entry_details (entry_id, option) VALUES (?, ?)",
+                    [(entry_id, opt) for opt in e.get("details") or []],
+                )
+                rows = []
+                for block, answer in (deep or {}).items():
+                    num = int(block[len("block"):])
+                    # пропущенный одиночный блок (None) строк не даёт — при чтении он вернётся как None
+                    for opt in answer if isinstance(answer, list) else [answer]:
+                        if opt is not None:
+                            rows.append((entry_id, num, opt))
+                self._conn.executemany("INSERT INTO entry_deep (entry_id, block, option) VALUES (?, ?, ?)", rows)
+        return self._conn.execute("SELECT MAX(id) FROM entries").fetchone()[0]
+
+    def iter_since(self, cursor=None) -> Iterator[tuple]:
+        # идём кусками по id, чтобы не держать в памяти всю таблицу; курсор — id последней записи
+        self.open()
+        last_id = cursor or 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, ts, user_id, photo, rating, city, has_deep, city_raw FROM entries WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, self.READ_CHUNK),
+                ).fetchall()
+                if not rows:
+                    return
+                lo, hi = rows[0][0], rows[-1][0]
+                details = self._conn.execute(
+                    "SELECT entry_id, option FROM entry_details WHERE entry_id BETWEEN ? AND ? ORDER BY rowid", (lo, hi)
+                ).fetchall()
+                deep = self._conn.execute(
+                    "SELECT entry_id, block, option FROM entry_deep WHERE entry_id BETWEEN ? AND ? ORDER BY rowid", (lo, hi)
+                ).fetchall()
+            details_by_id = {}
+            for entry_id, opt in details:
+                details_by_id.setdefault(entry_id, []).append(opt)
+            deep_by_id = {}
+            for entry_id, block, opt in deep:
+                deep_by_id.setdefault(entry_id, {}).setdefault(f"block{block}", []).append(opt)
+            for entry_id, ts, user_id, photo, rating, city, has_deep, city_raw in rows:
+                entry = {
+                    "user_id": user_id,
+                    "photo": photo,
+                    "rating": rating,
+                    "details": details_by_id.get(entry_id, []),
+                    "city": city,
+                    "deep": None,
+                    "ts": ts,
+                }
+                if city_raw is not None:
+                    entry["city_raw"] = city_raw
+                if has_deep:
+                    blocks = deep_by_id.get(entry_id, {})
+                    # блок 2 — одиночный выбор, храним строкой, как в исходной записи;
+                    # пустые мультивыборы строк не дают, восстанавливаем их как []
+                    entry["deep"] = {
+                        "block1": blocks.get("block1", []),
+                        "block2": blocks["block2"][0] if "block2" in blocks else None,
+                        "block3": blocks.get("block3", []),
+                        "block4": blocks.get("block4", []),
+                    }
+                yield entry_id, entry
+            last_id = hi
+
+    def _where(self, city=None, photo=None, rating=None):
+        clauses, params = [], []
+        for column, value in (("city", city), ("photo", photo), ("rating", rating)):
+            if value is not None:
+                clauses.append(f"e.{column} = ?")
+                params.append(value)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def rating_counts(self, city=None, photo=None) -> dict:
+        self.open()
+        where, params = self._where(city=city, photo=photo)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT e.rating, COUNT(*) FROM entries e{where} GROUP BY e.rating", params).fetchall()
+        return dict(rows)
+
+    def detail_counts(self, city=None, photo=None, rating=None) -> dict:
+        self.open()
+        where, params = self._where(city=city, photo=photo, rating=rating)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT d.option, COUNT(*) FROM entry_details d JOIN entries e ON e.id = d.entry_id{where} GROUP BY d.option",
+                params,
+            ).fetchall()
+        return dict(rows)
+
+    def deep_counts(self, block: int, city=None) -> dict:
+        self.open()
+        where, params = self._where(city=city)
+        where = (where + " AND" if where else " WHERE") + " d.block = ?"
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT d.option, COUNT(*) FROM entry_deep d JOIN entries e ON e.id = d.entry_id{where} GROUP BY d.option",
+                params + [block],
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.close()
+            self._conn = None
+
+
+_results_store: Optional[ResultsStore] = None
+
+
+def get_results_store() -> ResultsStore:
+    global _results_store
+    if _results_store is None:
+        stem = os.path.splitext(DATA_FILE)[0]
+        log = ResultsLog(stem + ".jsonl", legacy_path=DATA_FILE if DATA_FILE != stem + ".jsonl" else None,
+                         codec=RecordCodec(stem + ".codec.json"))
+        if RESULTS_BACKEND == "sqlite":
+            # при первом запуске забираем всё, что накопилось в журнале / старом DATA_FILE
+            _results_store = SqliteResultsStore(stem + ".sqlite3", import_from=log)
+        elif RESULTS_BACKEND == "jsonl":
+            _results_store = log
+        else:
+            raise ValueError(f"Неизвестное хранилище результатов: {RESULTS_BACKEND}")
+    return _results_store
+
+
+# -------------------- Утилиты --------------------
+def iter_results() -> Iterator[dict]:
+    return iter(get_results_store())
+
+def load_results() -> List[dict]:
+    return list(iter_results())
+
+def save_result(entry: dict):
+    get_results_store().append(entry)
+
+def save_results(entries: List[dict]):
+    return get_results_store().append_many(entries)
+
+
+def sync_results():
+    get_results_store().sync()
+
+
+# -------------------- Отложенная запись --------------------
+# очередь ограничена: при переполнении обработчик ждёт место (память не растёт, ответы не теряются)
+WRITE_QUEUE_SIZE = 1000
+WRITE_BATCH_SIZE = 100
+WRITE_RETRIES = 3
+
+
+class ResultWriter:
+    """Write-behind: обработчики кладут ответы в очередь, фоновая задача пишет их пачками."""
+
+    def __init__(self, sink=save_results, sync=sync_results, maxsize: int = WRITE_QUEUE_SIZE,
+                 batch_size: int = WRITE_BATCH_SIZE):
+        self.sink = sink
+        self.sync = sync
+        # записано после последнего sync — в затишье это нужно досинхронизировать
+        self._unsynced = False
+        # вызываются в event loop после успешной записи: listener(batch, cursor)
+        self.listeners = []
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+        self.backpressure_waits = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(self.maxsize)
+        self._task = asyncio.create_task(self._run(), name="result_writer")
+
+    async def put(self, entry: dict):
+        if self._queue.full():
+            self.backpressure_waits += 1
+            logger.debug("Очередь записи заполнена (%d), ждём воркер", self.maxsize)
+        await self._queue.put(entry)
+
+    async def _run(self):
+        while True:
+            try:
+                batch = [await asyncio.wait_for(self._queue.get(), FSYNC_INTERVAL)]
+            except asyncio.TimeoutError:
+                # хранилище синхронизирует по времени только на следующей записи; если её нет —
+                # хвост последней пачки доводим до диска сами
+                if self._unsynced:
+                    self._unsynced = False
+                    try:
+                        await asyncio.to_thread(self.sync)
+                    except Exception:
+                        logger.exception("Ошибка синхронизации хранилища ответов")
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch: List[dict]):
+        started = time.perf_counter()
+        for attempt in range(1, WRITE_RETRIES + 1):
+            try:
+                # диск трогаем вне event loop'а
+                cursor = await asyncio.to_thread(self.sink, batch)
+                break
+            except Exception:
+                logger.exception("Ошибка записи пачки из %d ответов (попытка %d)", len(batch), attempt)
+                if attempt == WRITE_RETRIES:
+                    # одна битая запись не должна утянуть за собой всю пачку — пишем по одной
+                    if len(batch) > 1:
+                        await self._flush_each(batch)
+                    else:
+                        self.dropped += 1
+                    return
+                await asyncio.sleep(0.5 * attempt)
+        self._written(batch, cursor, started)
+
+    async def _flush_each(self, batch: List[dict]):
+        for entry in batch:
+            started = time.perf_counter()
+            try:
+                cursor = await asyncio.to_thread(self.sink, [entry])
+            except Exception:
+                logger.exception("Ответ отброшен: не удалось записать %r", entry)
+                self.dropped += 1
+                continue
+            self._written([entry], cursor, started)
+
+    def _written(self, batch: List[dict], cursor, started: float):
+        self.written += len(batch)
+        self._unsynced = True
+        self.last_flush_latency = time.perf_counter() - started
+        metrics.observe("storage_write_seconds", self.last_flush_latency)
+        metrics.inc("storage_entries_written_total", len(batch))
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+        self.notify(batch, cursor)
+
+    def notify(self, batch: List[dict], cursor):
+        for listener in self.listeners:
+            try:
+                listener(batch, cursor)
+            except Exception:
+                logger.exception("Ошибка в обработчике записанных ответов")
+
+    async def stop(self):
+        if not self.running:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        logger.info("Запись ответов остановлена: записано %d, потеряно %d, макс. сброс %.3f с",
+                    self.written, self.dropped, self.max_flush_latency)
+
+
+result_writer = ResultWriter()
+
+
+async def enqueue_result(entry: dict):
+    if result_writer.running:
+        await result_writer.put(entry)
+    else:
+        cursor = await asyncio.to_thread(save_results, [entry])
+        result_writer.notify([entry], cursor)
+
+
+# -------------------- Статистика «портрета» --------------------
+# счётчики обновляются по мере записи ответов; снимок на диск — раз в N секунд и при остановке
+STATS_SNAPSHOT_INTERVAL = 300
+STATS_TOP_N = 5
+
+
+class PortraitStats:
+    """Инкрементальные счётчики по городам: фото × оценка, детали, варианты глубоких блоков."""
+
+    def __init__(self):
+        self.cities = {}
+        self.cursor = None
+        self.store_id = None
+        self._last_snapshot = time.monotonic()
+
+    def _city(self, city: str) -> dict:
+        c = self.cities.get(city)
+        if c is None:
+            c = self.cities[city] = {"total": 0, "ratings": {}, "photos": {}, "details": {}, "deep": {}}
+        return c
+
+    def add(self, entry: dict):
+        c = self._city(entry.get("city") or "—")
+        c["total"] += 1
+        rating = entry.get("rating") or "—"
+        c["ratings"][rating] = c["ratings"].get(rating, 0) + 1
+        photo = c["photos"].setdefault(entry.get("photo") or "—", {})
+        photo[rating] = photo.get(rating, 0) + 1
+        for opt in entry.get("details") or []:
+            c["details"][opt] = c["details"].get(opt, 0) + 1
+        for block, answer in (entry.get("deep") or {}).items():
+            counts = c["deep"].setdefault(block, {})
+            for opt in answer if isinstance(answer, list) else [answer]:
+                if opt is not None:
+                    counts[opt] = counts.get(opt, 0) + 1
+
+    def apply(self, entries: List[dict], cursor):
+        for entry in entries:
+            self.add(entry)
+        self.cursor = cursor
+
+    def replay(self, store: ResultsStore):
+        # догоняем хранилище с позиции снимка
+        applied = 0
+        for cursor, entry in store.iter_since(self.cursor):
+            self.add(entry)
+            self.cursor = cursor
+            applied += 1
+        return applied
+
+    def load(self, path: str, store: ResultsStore):
+        self.store_id = getattr(store, "path", None)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                snap = json.load(f)
+            if snap.get("store") == self.store_id:
+                self.cities = snap["cities"]
+                self.cursor = snap["cursor"]
+            else:
+                logger.info("Снимок %s от другого хранилища — пересчитываем", path)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.exception("Не удалось прочитать снимок статистики %s", path)
+        try:
+            applied = self.replay(store)
+        except Exception:
+            # курсор не подходит (например, журнал обрезан) — считаем заново
+            logger.exception("Снимок статистики не совпал с хранилищем — пересчитываем")
+            self.cities, self.cursor = {}, None
+            applied = self.replay(store)
+        logger.info("Статистика загружена: %d городов, догнано %d записей", len(self.cities), applied)
+
+    def snapshot(self) -> str:
+        self._last_snapshot = time.monotonic()
+        return json.dumps({"store": self.store_id, "cursor": self.cursor, "cities": self.cities},
+                          ensure_ascii=False, separators=(",", ":"))
+
+    def snapshot_due(self) -> bool:
+        return time.monotonic() - self._last_snapshot >= STATS_SNAPSHOT_INTERVAL
+
+    def report(self, city: str) -> str:
+        c = self.cities.get(city)
+        if not c:
+            return f"По городу «{city}» пока нет ответов."
+
+        def top(counts: dict) -> str:
+            items = sorted(counts.items(), key=lambda kv: -kv[1])[:STATS_TOP_N]
+            return ", ".join(f"{k} — {v}" for k, v in items) or "—"
+
+        lines = [
+            f"Портрет: {city}",
+            f"Ответов: {c['total']}",
+            f"Оценки: {top(c['ratings'])}",
+            f"Детали: {top(c['details'])}",
+        ]
+        for key in DEEP_BLOCKS:
+            if key in c["deep"]:
+                lines.append(f"{BLOCKS[key].title}: {top(c['deep'][key])}")
+        return "\n".join(lines)
+
+
+def write_file_atomic(path: str, text: str):
+    # временный файл уникален: один и тот же путь могут переписывать несколько процессов
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+portrait_stats = PortraitStats()
+
+
+def stats_snapshot_path() -> str:
+    return os.path.splitext(DATA_FILE)[0] + ".stats.json"
+
+
+def on_results_written(batch: List[dict], cursor):
+    portrait_stats.apply(batch, cursor)
+    photo_leaderboard.apply(batch)
+    if portrait_stats.snapshot_due():
+        # сериализуем здесь (согласованное состояние), на диск пишем в потоке
+        text = portrait_stats.snapshot()
+        asyncio.get_running_loop().run_in_executor(None, write_file_atomic, stats_snapshot_path(), text)
+
+
+result_writer.listeners.append(on_results_written)
+
+
+# -------------------- Рейтинг фото --------------------
+# Счётчики четырёх оценок по (город, фото) и по фото в целом; оценка одобрения — нижняя граница
+# Уилсона для доли «нравится», где уровни весят 1, 2/3, 1/3 и 0: фото с парой голосов не обгонит
+# фото с сотней. Порядок держим в отсортированном списке — top-k это срез, обновление — bisect.
+RATING_WEIGHTS = (1.0, 2 / 3, 1 / 3, 0.0)
+WILSON_Z = 1.96
+TOP_DEFAULT = 10
+TOP_MAX = 50
+ALL_CITIES = None
+
+
+def wilson_score(counts) -> float:
+    n = sum(counts)
+    if not n:
+        return 0.0
+    p = sum(w * c for w, c in zip(RATING_WEIGHTS, counts)) / n
+    z2 = WILSON_Z * WILSON_Z
+    centre = p + z2 / (2 * n)
+    margin = WILSON_Z * math.sqrt((p * (1 - p) + z2 / (4 * n)) / n)
+    return (centre - margin) / (1 + z2 / n)
+
+
+class PhotoLeaderboard:
+    """Инкрементальный рейтинг фото: город (или все города) -> отсортированный список (-score, -n, фото)."""
+
+    def __init__(self):
+        self.counts = {}
+        self.ranked = {}
+        # подпись оценки -> уровень 0..3; RATINGS объявлен ниже, поэтому строим при первом ответе
+        self._levels = None
+
+    def _bump(self, city, photo: str, level: int, n: int = 1):
+        counts = self.counts.setdefault(city, {}).get(photo)
+        ranked = self.ranked.setdefault(city, [])
+        if counts is None:
+            counts = self.counts[city][photo] = [0, 0, 0, 0]
+        else:
+            old = (-wilson_score(counts), -sum(counts), photo)
+            del ranked[bisect.bisect_left(ranked, old)]
+        counts[level] += n
+        bisect.insort(ranked, (-wilson_score(counts), -sum(counts), photo))
+
+    def add(self, entry: dict, n: int = 1):
+        if self._levels is None:
+            self._levels = {label: i for i, label in enumerate(RATINGS.values())}
+        level = self._levels.get(entry.get("rating"))
+        if level is None:
+            return
+        photo = entry.get("photo") or "—"
+        self._bump(entry.get("city") or "—", photo, level, n)
+        self._bump(ALL_CITIES, photo, level, n)
+
+    def apply(self, entries: List[dict]):
+        for entry in entries:
+            self.add(entry)
+
+    def rebuild(self, stats: "PortraitStats"):
+        # те же счётчики уже есть в статистике «портрета» — не перечитываем хранилище
+        self.counts, self.ranked = {}, {}
+        for city, c in stats.cities.items():
+            for photo, ratings in c["photos"].items():
+                for rating, n in ratings.items():
+                    self.add({"city": city, "photo": photo, "rating": rating}, n)
+
+    def top(self, city=ALL_CITIES, k: int = TOP_DEFAULT) -> List[tuple]:
+        """[(фото, оценка, [n1, n2, n3, n4])] — лучшие k."""
+        counts = self.counts.get(city, {})
+        return [(photo, -neg_score, counts[photo]) for neg_score, _, photo in self.ranked.get(city, [])[:k]]
+
+    def report(self, city=ALL_CITIES, k: int = TOP_DEFAULT) -> str:
+        rows = self.top(city, k)
+        where = city if city is not ALL_CITIES else "все города"
+        if not rows:
+            return f"Рейтинг фото ({where}): пока нет оценок."
+        marks = [label.split()[0] for label in RATINGS.values()]
+        lines = [f"Рейтинг фото ({where}), топ-{len(rows)}:"]
+        for place, (photo, score, counts) in enumerate(rows, 1):
+            votes = " · ".join(f"{mark} {n}" for mark, n in zip(marks, counts))
+            lines.append(f"{place}. {photo} — {score:.2f} ({votes})")
+        return "\n".join(lines)
+
+
+photo_leaderboard = PhotoLeaderboard()
+
+
+def load_stats():
+    portrait_stats.load(stats_snapshot_path(), get_results_store())
+    photo_leaderboard.rebuild(portrait_stats)
+
+def build_entry(context: ContextTypes.DEFAULT_TYPE, deep: bool) -> dict:
+    # в user_data — только ключи и маски, подписи вариантов подставляем здесь
+    ud = context.user_data
+    return {
+        "user_id": ud.get("uid"),
+        "photo": ud.get("current_photo"),
+        "rating": RATINGS.get(ud.get("rating")),
+        "details": selected_details(context),
+        "city": ud.get("city"),
+        **({"city_raw": ud["city_raw"]} if ud.get("city_raw") else {}),
+        "deep": {key: deep_answer(BLOCKS[key], mask) for key, mask in ud.get("deep", {}).items()} if deep else None,
+        "ts": time.time(),
+    }
+
+# -------------------- Каталог фото --------------------
+# photos.json: [{"id": "egor_01", "file_id": "..."}, {"id": "egor_02", "path": "photos/02.jpg"}, ...]
+# Локальные файлы загружаются в Telegram один раз, полученные file_id кэшируются в PHOTO_FILE_ID_CACHE.
+# Без каталога пул берётся из PHOTO_IDS.
+PHOTO_CATALOGUE_FILE = "photos.json"
+PHOTO_FILE_ID_CACHE = "photos.file_ids.json"
+PHOTOS_PER_ALBUM = 2
+ALBUM_CAPTION = "Оцени фото 👇\n\nТвой выбор анонимен."
+
+
+class CataloguePhoto:
+    __slots__ = ("id", "path", "file_id", "shown", "_media")
+
+    def __init__(self, photo_id: str, path: Optional[str] = None, file_id: Optional[str] = None):
+        self.id = photo_id
+        self.path = path
+        self.file_id = file_id
+        # сколько раз фото было оцениваемым (первым в альбоме); остальные места альбома — контекст
+        self.shown = 0
+        self._media = {}
+
+    def media(self, caption: Optional[str]) -> InputMediaPhoto:
+        if self.file_id is None:
+            # ещё не загружено — отправляем сам файл (объект одноразовый, не кэшируем)
+            with open(self.path, "rb") as f:
+                return InputMediaPhoto(media=f, caption=caption)
+        media = self._media.get(caption)
+        if media is None:
+            media = self._media[caption] = InputMediaPhoto(media=self.file_id, caption=caption)
+        return media
+
+
+class PhotoCatalogue:
+    """Пул фото с кэшем file_id и round-robin выдачей: показы по фото выравниваются."""
+
+    def __init__(self, path: str = PHOTO_CATALOGUE_FILE, cache_path: str = PHOTO_FILE_ID_CACHE,
+                 shared_cache_path: Optional[str] = None):
+        self.path = path
+        self.cache_path = cache_path
+        # у воркера шарда свой кэш; общий (от обычного запуска) он только читает
+        self.shared_cache_path = shared_cache_path
+        self.photos: List[CataloguePhoto] = []
+        self._cursor = 0
+        self._file_ids = {}
+
+    def _read_cache(self, path: str) -> dict:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+            if not isinstance(cache, dict):
+                raise ValueError("ожидался объект")
+            return cache
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            # кэш — только ускорение: без него фото просто загрузятся заново
+            logger.exception("Кэш file_id %s испорчен — игнорируем", path)
+            return {}
+
+    def load(self):
+        file_ids = self._read_cache(self.shared_cache_path) if self.shared_cache_path else {}
+        file_ids.update(self._read_cache(self.cache_path))
+        self._file_ids = file_ids
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                spec = json.load(f)
+        else:
+            spec = [{"id": file_id, "file_id": file_id} for file_id in PHOTO_IDS]
+        previous = {p.id: p for p in self.photos}
+        photos = []
+        for item in spec:
+            path = item.get("path")
+            photo = CataloguePhoto(item["id"], path, item.get("file_id") or self._cached_file_id(path))
+            if photo.id in previous:
+                photo.shown = previous[photo.id].shown
+            photos.append(photo)
+        # новые фото ставим в начало очереди, чтобы они быстрее догнали остальные по показам
+        photos.sort(key=lambda p: p.shown)
+        self.photos, self._cursor = photos, 0
+        logger.info("Каталог фото: %d фото, из них без file_id %d", len(photos), sum(p.file_id is None for p in photos))
+
+    def _cached_file_id(self, path: Optional[str]) -> Optional[str]:
+        if not path:
+            return None
+        cached = self._file_ids.get(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return cached.get("file_id") if cached else None
+        if cached and cached.get("size") == stat.st_size and cached.get("mtime") == stat.st_mtime:
+            return cached["file_id"]
+        return None
+
+    def next_album(self, size: int = PHOTOS_PER_ALBUM) -> List[CataloguePhoto]:
+        """Альбом из size фото; оценивается первое. Курсор идёт на одно фото, а не на альбом —
+        иначе при чётном пуле фото на нечётных местах показывались бы, но никогда не оценивались."""
+        photos = self.photos
+        if not photos:
+            return []
+        size = min(size, len(photos))
+        start = self._cursor
+        self._cursor = (start + 1) % len(photos)
+        album = [photos[(start + i) % len(photos)] for i in range(size)]
+        album[0].shown += 1
+        return album
+
+    def remember_uploads(self, album: List[CataloguePhoto], messages) -> bool:
+        """Запоминает file_id только что загруженных фото; True — если кэш изменился."""
+        changed = False
+        for photo, message in zip(album, messages):
+            if photo.file_id is None and message.photo:
+                photo.file_id = message.photo[-1].file_id
+                stat = os.stat(photo.path)
+                self._file_ids[photo.path] = {"file_id": photo.file_id, "size": stat.st_size, "mtime": stat.st_mtime}
+                changed = True
+        return changed
+
+    def cache_snapshot(self) -> str:
+        return json.dumps(self._file_ids, ensure_ascii=False, indent=2)
+
+
+photo_catalogue = PhotoCatalogue()
+
+# -------------------- Состояние диалогов --------------------
+# незаконченные опросы переживают перезапуск; брошенные — истекают через SESSION_TTL
+SESSION_TTL = 24 * 3600
+SESSION_SWEEP_INTERVAL = 600
+# как часто PTB отдаёт накопленные изменения в persistence
+PERSISTENCE_INTERVAL = 5
+
+
+class SurveyPersistence(BasePersistence):
+    """user_data и состояния ConversationHandler в SQLite; запись пачками, с TTL."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id INTEGER PRIMARY KEY,
+            ts REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            conv_key TEXT NOT NULL,
+            ts REAL NOT NULL,
+            state INTEGER NOT NULL,
+            PRIMARY KEY (name, conv_key)
+        );
+    """
+
+    def __init__(self, path: str, ttl: float = SESSION_TTL, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.ttl = ttl
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._users = {}
+        self._convs = {}
+        self._writer = WriteBehind(self._write, "состояние диалогов")
+        # когда пользователь последний раз что-то менял — по этому чистим память
+        self.last_seen = {}
+        # живые диалоги: ключ -> состояние (для метрик) и ключ -> время последнего шага
+        self.live = {}
+        self.live_seen = {}
+
+    def _open(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = open_sqlite(self.path, self.SCHEMA)
+        return self._conn
+
+    def _expire(self, conn: sqlite3.Connection) -> float:
+        cutoff = time.time() - self.ttl
+        with conn:
+            conn.execute("DELETE FROM user_state WHERE ts < ?", (cutoff,))
+            conn.execute("DELETE FROM conversations WHERE ts < ?", (cutoff,))
+        return cutoff
+
+    async def get_user_data(self) -> dict:
+        def load():
+            with self._lock:
+                conn = self._open()
+                self._expire(conn)
+                return conn.execute("SELECT user_id, ts, data FROM user_state").fetchall()
+        rows = await asyncio.to_thread(load)
+        self.last_seen = {user_id: ts for user_id, ts, _ in rows}
+        return {user_id: json.loads(data) for user_id, _, data in rows}
+
+    async def get_conversations(self, name: str) -> dict:
+        def load():
+            with self._lock:
+                conn = self._open()
+                self._expire(conn)
+                return conn.execute("SELECT conv_key, state, ts FROM conversations WHERE name = ?", (name,)).fetchall()
+        rows = await asyncio.to_thread(load)
+        conversations = {}
+        for key, state, ts in rows:
+            key = tuple(json.loads(key))
+            conversations[key] = state
+            self.live[(name, key)] = state
+            self.live_seen[(name, key)] = ts
+        return conversations
+
+    async def update_user_data(self, user_id: int, data: dict):
+        now = time.time()
+        self.last_seen[user_id] = now
+        self._users[user_id] = (now, json.dumps(data, ensure_ascii=False, separators=(",", ":")) if data else None)
+        self._writer.schedule()
+
+    async def drop_user_data(self, user_id: int):
+        self.last_seen.pop(user_id, None)
+        self._users[user_id] = (time.time(), None)
+        self._writer.schedule()
+
+    async def update_conversation(self, name: str, key, new_state: Optional[object]):
+        now = time.time()
+        if new_state is None:
+            self.live.pop((name, key), None)
+            self.live_seen.pop((name, key), None)
+        else:
+            self.live[(name, key)] = new_state
+            self.live_seen[(name, key)] = now
+        self._convs[(name, json.dumps(list(key)))] = (now, new_state)
+        self._writer.schedule()
+
+    def expired_conversations(self, cutoff: float) -> List[tuple]:
+        return [name_key for name_key, ts in self.live_seen.items() if ts < cutoff]
+
+    def _write(self):
+        users, self._users = self._users, {}
+        convs, self._convs = self._convs, {}
+        if not users and not convs:
+            return
+        with self._lock:
+            conn = self._open()
+            with conn:
+                conn.executemany("DELETE FROM user_state WHERE user_id = ?",
+                                 [(uid,) for uid, (_, data) in users.items() if data is None])
+                conn.executemany("INSERT OR REPLACE INTO user_state (user_id, ts, data) VALUES (?, ?, ?)",
+                                 [(uid, ts, data) for uid, (ts, data) in users.items() if data is not None])
+                conn.executemany("DELETE FROM conversations WHERE name = ? AND conv_key = ?",
+                                 [key for key, (_, state) in convs.items() if state is None])
+                conn.executemany("INSERT OR REPLACE INTO conversations (name, conv_key, ts, state) VALUES (?, ?, ?, ?)",
+                                 [(name, key, ts, state) for (name, key), (ts, state) in convs.items() if state is not None])
+
+    async def flush(self):
+        await self._writer.wait()
+        await asyncio.to_thread(self._write)
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # chat_data, bot_data и callback_data не храним
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+
+def shard_suffix() -> str:
+    return f".shard{WORKER_SHARD}" if WORKER_SHARD is not None else ""
+
+
+def state_file_path() -> str:
+    return os.path.splitext(DATA_FILE)[0] + shard_suffix() + ".state.sqlite3"
+
+
+async def sweep_sessions(app):
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        expire_sessions(app)
+
+
+def end_conversation(handler: ConversationHandler, key):
+    """Закрывает диалог так же, как встроенный таймаут PTB, — удаление дойдёт и до persistence.
+
+    Публичного способа нет: опираемся на приватный ConversationHandler._update_state (им заканчивается
+    _trigger_timeout в PTB 22.x). При обновлении python-telegram-bot проверить первым.
+    """
+    handler._update_state(ConversationHandler.END, key)
+
+
+def expire_sessions(app, now: Optional[float] = None):
+    """Закрывает брошенные диалоги и выгружает из памяти user_data тех, кто давно молчит или уже закончил опрос."""
+    persistence = app.persistence
+    now = now or time.time()
+    cutoff = now - SESSION_TTL
+    # conversation_timeout не ставим: ему нужен JobQueue (python-telegram-bot[job-queue]), а закрываем мы и так здесь
+    handlers = {handler.name: handler for handler in itertools.chain.from_iterable(app.handlers.values())
+                if isinstance(handler, ConversationHandler)}
+    ended = 0
+    for name, key in persistence.expired_conversations(cutoff):
+        handler = handlers.get(name)
+        if handler is None:
+            continue
+        end_conversation(handler, key)
+        ended += 1
+    dropped = 0
+    for user_id, data in list(app.user_data.items()):
+        # свежие изменения могли ещё не дойти до persistence — считаем их активными
+        if not data or persistence.last_seen.setdefault(user_id, now) < cutoff:
+            app.drop_user_data(user_id)
+            persistence.last_seen.pop(user_id, None)
+            dropped += 1
+    if ended or dropped:
+        logger.info("Закрыто %d брошенных диалогов, выгружено %d неактивных сессий, в памяти %d",
+                    ended, dropped, len(app.user_data))
+
+
+# -------------------- Идемпотентность --------------------
+# Повторная доставка апдейта или двойное нажатие на последней кнопке не должны давать второй ответ.
+# Ключи: id апдейта/callback'а и (user_id, фото, сессия); помним их SEEN_WINDOW секунд.
+SEEN_WINDOW = SESSION_TTL
+SEEN_CACHE_SIZE = 100_000
+
+
+class CompletionIndex:
+    """LRU в памяти + SQLite на диске. Проверка — только по памяти; диск нужен, чтобы пережить перезапуск."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS seen (
+            key TEXT PRIMARY KEY,
+            ts REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS seen_ts ON seen (ts);
+    """
+
+    def __init__(self, window: float = SEEN_WINDOW, capacity: int = SEEN_CACHE_SIZE):
+        self.window = window
+        self.capacity = capacity
+        self.path: Optional[str] = None
+        self._seen = OrderedDict()
+        self._pending = []
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._writer = WriteBehind(self._write, "индекс завершений")
+        # самый свежий ключ, вытесненный из LRU: пока он в окне, память покрывает окно не целиком
+        self._evicted_ts = 0.0
+        self.duplicates = 0
+
+    def _open(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = open_sqlite(self.path, self.SCHEMA)
+        return self._conn
+
+    def load(self, path: str):
+        self.path = path
+        cutoff = time.time() - self.window
+        with self._lock:
+            conn = self._open()
+            with conn:
+                conn.execute("DELETE FROM seen WHERE ts < ?", (cutoff,))
+            rows = conn.execute("SELECT key, ts FROM seen ORDER BY ts DESC LIMIT ?", (self.capacity,)).fetchall()
+            if len(rows) == self.capacity:
+                self._evicted_ts = rows[-1][1]
+        self._seen = OrderedDict(reversed(rows))
+
+    def _remember(self, key: str, ts: float):
+        self._seen[key] = ts
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.capacity:
+            _, evicted = self._seen.popitem(last=False)
+            self._evicted_ts = max(self._evicted_ts, evicted)
+
+    def _on_disk(self, keys, cutoff: float) -> bool:
+        with self._lock:
+            conn = self._open()
+            marks = ",".join("?" * len(keys))
+            return conn.execute(f"SELECT 1 FROM seen WHERE ts >= ? AND key IN ({marks}) LIMIT 1",
+                                (cutoff, *keys)).fetchone() is not None
+
+    async def claim(self, keys) -> bool:
+        """True — ключи новые и теперь заняты; False — это повтор."""
+        keys = [key for key in keys if key]
+        now = time.time()
+        cutoff = now - self.window
+        for key in keys:
+            ts = self._seen.get(key)
+            if ts is not None and ts >= cutoff:
+                self.duplicates += 1
+                return False
+        # память покрывает окно не полностью — тогда (и только тогда) спрашиваем диск
+        if self.path and self._evicted_ts >= cutoff and await asyncio.to_thread(self._on_disk, keys, cutoff):
+            self.duplicates += 1
+            return False
+        for key in keys:
+            self._remember(key, now)
+            self._pending.append((key, now))
+        if self.path:
+            self._writer.schedule()
+        return True
+
+    def _write(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        with self._lock:
+            conn = self._open()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO seen (key, ts) VALUES (?, ?)", pending)
+                conn.execute("DELETE FROM seen WHERE ts < ?", (time.time() - self.window,))
+
+    async def close(self):
+        await self._writer.wait()
+        if self.path:
+            await asyncio.to_thread(self._write)
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def completion_index_path() -> str:
+    # ключи одного чата всегда в одном шарде — индекс у каждого шарда свой
+    return os.path.splitext(DATA_FILE)[0] + shard_suffix() + ".seen.sqlite3"
+
+
+def completion_keys(update: Update, context: ContextTypes.DEFAULT_TYPE) -> List[str]:
+    ud = context.user_data
+    keys = [f"u:{update.update_id}"]
+    if update.callback_query is not None:
+        keys.append(f"cb:{update.callback_query.id}")
+    # до появления session у старых незаконченных опросов её нет — тогда только по апдейту
+    if ud.get("session"):
+        keys.append(f"s:{ud.get('uid')}:{ud.get('current_photo')}:{ud['session']}")
+    return keys
+
+
+completion_index = CompletionIndex()
+
+
+# -------------------- Опрос --------------------
+# Опрос описан данными: блоки, варианты, одиночный/множественный выбор и переходы.
+# Выбор в мультиблоке хранится битовой маской (бит i — вариант i).
+RATINGS = {
+    "rate_1": "❤️ Нравится",
+    "rate_2": "💛 Скорее нравится",
+    "rate_3": "💙 Скорее не нравится",
+    "rate_4": "💔 Не нравится",
+}
+POSITIVE_RATINGS = ("rate_1", "rate_2")
+CITIES = ("Минск", "Гродно", "Гомель", "Могилёв", "Брест")
+
+SURVEY = {
+    "details_positive": {
+        "prompt": "Ты выбрал: {rating}\n\nА что понравилось больше всего? Можно выбрать несколько вариантов.",
+        "options": ("🙂 Улыбка", "👀 Глаза", "🌿 Вайб / энергетика", "👔 Стиль одежды",
+                    "🙂 Черты лица", "💪 Телосложение", "🧍‍♂️ Осанка", "⭐️ Просто понравился"),
+        "multi": True,
+        "code": "P",
+        "next": "➡️ Пропустить",
+    },
+    "details_negative": {
+        "prompt": "Ты выбрал: {rating}\n\nА что больше всего не зашло? Можно выбрать несколько вариантов.",
+        "options": ("👔 Стиль", "🙂 Лицо / мимика", "🧍‍♂️ Осанка", "🧢 Прическа / волосы",
+                    "🤷 Не мой типаж", "🔞 Слишком молодой", "📅 Слишком взрослый", "❌ Просто не зашёл"),
+        "multi": True,
+        "code": "N",
+        "next": "➡️ Пропустить",
+    },
+    "city": {
+        "prompt": "Спасибо! Теперь, из какого ты города? Это нужно, чтобы собрать карту предпочтений.",
+        "options": CITIES,
+        "multi": False,
+        "code": "C",
+        # «дальше» здесь — переход к вводу своего города
+        "next": "Другой город",
+    },
+    "block1": {
+        "title": "Черты лица",
+        "prompt": "Какие черты лица тебе нравятся? Выбери всё, что подходит.",
+        "options": ("Мягкие черты", "Выраженные скулы", "Широкая челюсть", "Узкое лицо", "Круглое лицо",
+                    "Светлая кожа", "Тёмная кожа", "Волосы: короткие", "Волосы: длинные", "Не важно"),
+        "multi": True,
+        "code": "1",
+        "next": "➡️ Дальше",
+        "then": "block2",
+        "state": DEEP_BLOCK1,
+    },
+    "block2": {
+        "title": "Телосложение",
+        "prompt": "Какое телосложение тебе ближе?",
+        "options": ("Худощавый", "Средний", "Спортивный", "Крепкий", "Не важно"),
+        "multi": False,
+        "code": "2",
+        "next": "➡️ Дальше",
+        "then": "block3",
+        "state": DEEP_BLOCK2,
+    },
+    "block3": {
+        "title": "Стиль",
+        "prompt": "В каком стиле парень выглядит привлекательнее?",
+        "options": ("Кежуал", "Спортивный", "Офисный (рубашка/пиджак)", "Уличный / streetwear",
+                    "Минимализм", "Творческий", "Гранж / рок", "Брутальный", "Аккуратный, ухоженный", "Не важно"),
+        "multi": True,
+        "code": "3",
+        "next": "➡️ Дальше",
+        "then": "block4",
+        "state": DEEP_BLOCK3,
+    },
+    "block4": {
+        "title": "Вайб",
+        "prompt": "Какой вайб (атмосфера) тебя привлекает больше всего?",
+        "options": ("Добрый", "Уверенный", "Спокойный", "Харизматичный", "Заботливый",
+                    "Дерзкий / хулиган", "Интеллектуальный", "Весёлый / лёгкий", "Серьёзный",
+                    "Интровертный", "Экстравертный"),
+        "multi": True,
+        "code": "4",
+        "next": "➡️ Дальше",
+        "then": None,
+        "state": DEEP_BLOCK4,
+    },
+}
+DEEP_FIRST_BLOCK = "block1"
+DEEP_BLOCKS = ("block1", "block2", "block3", "block4")
+
+
+# -------------------- Города --------------------
+# Свободный ввод города сводим к каноническому названию ещё при приёме ответа:
+# NFKC + casefold, латиница -> кириллица, белорусские і/ў -> и/у, затем точное или нечёткое
+# (по триграммам) совпадение со справочником. Сырой ввод сохраняется рядом — в city_raw.
+# Справочник: GAZETTEER_FILE ({"Минск": ["Minsk", "Мінск"], ...}); без файла — встроенный GAZETTEER.
+GAZETTEER_FILE = "cities.json"
+GAZETTEER = {
+    "Минск": ("Minsk", "Мінск", "Мн"),
+    "Гродно": ("Grodno", "Hrodna", "Гродна"),
+    "Гомель": ("Gomel", "Homel", "Homiel", "Гомель"),
+    "Могилёв": ("Mogilev", "Mahilyow", "Mahiloŭ", "Магілёў"),
+    "Брест": ("Brest", "Берасце", "Brest-Litovsk"),
+    "Витебск": ("Vitebsk", "Viciebsk", "Віцебск"),
+    "Бобруйск": ("Bobruisk", "Babruysk", "Бабруйск"),
+    "Барановичи": ("Baranovichi", "Baranavichy", "Баранавічы"),
+    "Борисов": ("Borisov", "Barysaw", "Барысаў"),
+    "Пинск": ("Pinsk",),
+    "Орша": ("Orsha", "Ворша"),
+    "Мозырь": ("Mozyr", "Mazyr", "Мазыр"),
+    "Солигорск": ("Soligorsk", "Salihorsk", "Салігорск"),
+    "Новополоцк": ("Novopolotsk", "Navapolatsk", "Наваполацк"),
+    "Полоцк": ("Polotsk", "Polatsk", "Полацк"),
+    "Лида": ("Lida", "Ліда"),
+    "Молодечно": ("Molodechno", "Maladzyechna", "Маладзечна"),
+    "Жлобин": ("Zhlobin", "Жлобін"),
+    "Светлогорск": ("Svetlogorsk", "Svetlahorsk", "Светлагорск"),
+    "Речица": ("Rechitsa", "Rechytsa", "Рэчыца"),
+    "Слуцк": ("Slutsk",),
+    "Жодино": ("Zhodino", "Жодзіна"),
+    "Кобрин": ("Kobrin", "Kobryn", "Кобрын"),
+    "Слоним": ("Slonim", "Слонім"),
+    "Волковыск": ("Volkovysk", "Vawkavysk", "Ваўкавыск"),
+    "Калинковичи": ("Kalinkovichi", "Калінкавічы"),
+    "Сморгонь": ("Smorgon", "Smarhon", "Смаргонь"),
+    "Рогачёв": ("Rogachev", "Rahachow", "Рагачоў"),
+    "Осиповичи": ("Osipovichi", "Asipovichy", "Асіповічы"),
+    "Горки": ("Gorki", "Horki", "Горкі"),
+    "Новогрудок": ("Novogrudok", "Navahrudak", "Навагрудак"),
+    "Вилейка": ("Vileyka", "Vilejka", "Вілейка"),
+    "Дзержинск": ("Dzerzhinsk", "Dzyarzhynsk", "Дзяржынск"),
+    "Берёза": ("Bereza", "Biaroza", "Бяроза"),
+    "Марьина Горка": ("Maryina Gorka", "Мар'іна Горка"),
+    "Лунинец": ("Luninets", "Luninyets", "Лунінец"),
+    "Кричев": ("Krichev", "Krychaw", "Крычаў"),
+    "Быхов": ("Bykhov", "Bykhaw", "Быхаў"),
+    "Несвиж": ("Nesvizh", "Nyasvizh", "Нясвіж"),
+    "Глубокое": ("Glubokoye", "Hlybokaye", "Глыбокае"),
+    "Поставы": ("Postavy", "Pastavy", "Паставы"),
+    "Шклов": ("Shklov", "Shklow", "Шклоў"),
+    "Заславль": ("Zaslavl", "Izyaslawl", "Заслаўе"),
+    "Фаниполь": ("Fanipol", "Фаніпаль"),
+}
+CITY_MATCH_THRESHOLD = 0.7
+CITY_EDIT_SPAN = 4
+CITY_CACHE_SIZE = 4096
+
+# сначала многобуквенные сочетания, потом одиночные буквы
+LATIN_TO_CYRILLIC = (
+    ("shch", "щ"), ("sch", "щ"), ("zh", "ж"), ("kh", "х"), ("ch", "ч"), ("sh", "ш"), ("ts", "ц"),
+    ("ya", "я"), ("yu", "ю"), ("ye", "е"), ("yo", "е"), ("ia", "я"), ("iu", "ю"),
+    ("a", "а"), ("b", "б"), ("c", "ц"), ("d", "д"), ("e", "е"), ("f", "ф"), ("g", "г"), ("h", "г"),
+    ("i", "и"), ("j", "й"), ("k", "к"), ("l", "л"), ("m", "м"), ("n", "н"), ("o", "о"), ("p", "п"),
+    ("q", "к"), ("r", "р"), ("s", "с"), ("t", "т"), ("u", "у"), ("v", "в"), ("w", "в"), ("x", "кс"),
+    ("y", "ы"), ("z", "з"), ("ŭ", "у"), ("ĺ", "л"), ("ś", "с"), ("ć", "ц"), ("ź", "з"), ("ń", "н"),
+    ("č", "ч"), ("š", "ш"), ("ž", "ж"),
+)
+LATIN_PATTERN = re.compile("|".join(re.escape(src) for src, _ in LATIN_TO_CYRILLIC))
+LATIN_MAP = dict(LATIN_TO_CYRILLIC)
+# буквы, которые при сравнении не различаем: ё/е, й/ы/і -> и, ў -> у, э -> е; мягкий и твёрдый знак — долой
+CITY_FOLD = str.maketrans({"ё": "е", "й": "и", "ы": "и", "і": "и", "ї": "и", "ў": "у", "э": "е", "ъ": None, "ь": None,
+                           "'": None, "’": None, "ʼ": None, "-": " ", ".": " ", ",": " "})
+# префиксы снимаем до транслитерации, поэтому латинские — в исходном виде
+CITY_PREFIXES = ("город ", "гор ", "г ", "горад ", "city ", "gorod ", "horad ", "g ")
+
+
+def normalize_city(text: str) -> str:
+    key = unicodedata.normalize("NFKC", text).casefold()
+    key = " ".join(key.translate(CITY_FOLD).split())
+    for prefix in CITY_PREFIXES:
+        if key.startswith(prefix):
+            key = key[len(prefix):]
+            break
+    # после транслитерации ещё раз сворачиваем: й/ы из латиницы -> и
+    return LATIN_PATTERN.sub(lambda m: LATIN_MAP[m.group()], key).translate(CITY_FOLD)
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Расстояние Левенштейна; как только оно заведомо больше limit, возвращает limit + 1."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def city_trigrams(key: str) -> frozenset:
+    padded = f" {key} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class CityResolver:
+    """Справочник городов: точный поиск по нормализованному ключу и нечёткий — по индексу триграмм."""
+
+    def __init__(self, path: str = GAZETTEER_FILE):
+        self.path = path
+        self.exact = {}
+        self.grams = []
+        self.index = {}
+        self.loaded = False
+
+    def load(self):
+        gazetteer = GAZETTEER
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                gazetteer = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.exception("Не удалось прочитать справочник городов %s, берём встроенный", self.path)
+        exact, grams, index = {}, [], {}
+        for name, aliases in gazetteer.items():
+            for alias in (name, *aliases):
+                key = normalize_city(alias)
+                if not key or key in exact:
+                    continue
+                exact[key] = name
+                idx = len(grams)
+                grams.append((name, key, city_trigrams(key)))
+                for gram in grams[idx][2]:
+                    index.setdefault(gram, []).append(idx)
+        # кнопочные города — всегда канонические
+        for name in CITIES:
+            exact.setdefault(normalize_city(name), name)
+        self.exact, self.grams, self.index = exact, grams, index
+        self.loaded = True
+        resolve_city.cache_clear()
+        logger.info("Справочник городов: %d названий", len(exact))
+
+    def match(self, key: str) -> Optional[str]:
+        if not self.loaded:
+            self.load()
+        name = self.exact.get(key)
+        if name is not None or len(key) < 4:
+            return name
+        query = city_trigrams(key)
+        common = {}
+        for gram in query:
+            for idx in self.index.get(gram, ()):
+                common[idx] = common.get(idx, 0) + 1
+        scored = []
+        for idx, shared in common.items():
+            candidate, candidate_key, grams = self.grams[idx]
+            # коэффициент Дайса по триграммам
+            score = 2 * shared / (len(query) + len(grams))
+            if score >= CITY_MATCH_THRESHOLD:
+                scored.append((score, candidate, candidate_key))
+        # триграммы прощают лишние буквы: «Минусинск» похож на «Минск» на 0.71. Поэтому кандидата ещё
+        # проверяем правками — не больше одной на каждые CITY_EDIT_SPAN букв названия
+        for score, candidate, candidate_key in sorted(scored, key=lambda item: -item[0]):
+            limit = max(1, len(candidate_key) // CITY_EDIT_SPAN)
+            if edit_distance(key, candidate_key, limit) <= limit:
+                return candidate
+        return None
+
+
+city_resolver = CityResolver()
+
+
+@functools.lru_cache(maxsize=CITY_CACHE_SIZE)
+def resolve_city(text: str) -> str:
+    """Каноническое название города; незнакомый город — как ввели, без лишних пробелов и с заглавной."""
+    clean = " ".join(text.split())
+    key = normalize_city(clean)
+    if not key:
+        return clean
+    return city_resolver.match(key) or clean[:1].upper() + clean[1:]
+
+
+# -------------------- callback_data --------------------
+# Компактный формат: <версия><действие><код блока><номер варианта в base62>, например "1tP3".
+# Вместо текста варианта — его номер, так что payload укладывается в несколько байт.
+CALLBACK_VERSION = "1"
+ACTION_TOGGLE = "t"
+ACTION_NEXT = "n"
+BASE62 = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+BASE62_INDEX = {ch: i for i, ch in enumerate(BASE62)}
+
+
+class SurveyCallback(NamedTuple):
+    action: str
+    block: "SurveyBlock"
+    option: Optional[int]
+
+
+def encode_callback(action: str, block_code: str, option: Optional[int] = None) -> str:
+    data = CALLBACK_VERSION + action + block_code
+    if option is not None:
+        digits = ""
+        while True:
+            option, rem = divmod(option, 62)
+            digits = BASE62[rem] + digits
+            if not option:
+                break
+        data += digits
+    return data
+
+
+def decode_callback(data: Optional[str]) -> Optional[SurveyCallback]:
+    # чужие и устаревшие (до смены формата) callback_data дают None
+    if not data or len(data) < 3 or data[0] != CALLBACK_VERSION:
+        return None
+    block = BLOCKS_BY_CODE.get(data[2])
+    if block is None:
+        return None
+    action = data[1]
+    if action == ACTION_NEXT:
+        return SurveyCallback(action, block, None) if len(data) == 3 else None
+    if action != ACTION_TOGGLE or len(data) == 3:
+        return None
+    option = 0
+    for ch in data[3:]:
+        digit = BASE62_INDEX.get(ch)
+        if digit is None:
+            return None
+        option = option * 62 + digit
+    if option >= len(block.options):
+        return None
+    return SurveyCallback(action, block, option)
+
+
+def survey_pattern(*codes: str):
+    """pattern для CallbackQueryHandler: пропускает только callback'и указанных блоков."""
+    codes = frozenset(codes)
+
+    def check(data) -> bool:
+        cb = decode_callback(data) if isinstance(data, str) else None
+        return cb is not None and cb.block.code in codes
+    return check
+
+
+class SurveyBlock:
+    """Скомпилированный блок: неизменяемые кнопки и кэш клавиатур по маске выбора."""
+
+    def __init__(self, key: str, spec: dict):
+        self.key = key
+        self.title = spec.get("title", key)
+        self.prompt = spec["prompt"]
+        self.options = tuple(spec["options"])
+        self.multi = spec["multi"]
+        self.code = spec["code"]
+        self.then = spec.get("then")
+        self.state = spec.get("state")
+        self.index = {opt: i for i, opt in enumerate(self.options)}
+        self.next_data = encode_callback(ACTION_NEXT, self.code)
+        toggles = [encode_callback(ACTION_TOGGLE, self.code, i) for i in range(len(self.options))]
+        self._plain = tuple((InlineKeyboardButton(opt, callback_data=cb),) for opt, cb in zip(self.options, toggles))
+        self._checked = tuple((InlineKeyboardButton(f"✅ {opt}", callback_data=cb),) for opt, cb in zip(self.options, toggles))
+        self._bottom = ((InlineKeyboardButton(spec["next"], callback_data=self.next_data),),)
+        # масок не больше 2^len(options) — для наших блоков это максимум пара тысяч клавиатур
+        self._cache = {}
+
+    def keyboard(self, mask: int = 0) -> InlineKeyboardMarkup:
+        markup = self._cache.get(mask)
+        if markup is None:
+            rows = tuple(
+                self._checked[i] if mask >> i & 1 else self._plain[i] for i in range(len(self.options))
+            )
+            markup = self._cache[mask] = InlineKeyboardMarkup(rows + self._bottom)
+        return markup
+
+    def labels(self, mask: int) -> List[str]:
+        return [opt for i, opt in enumerate(self.options) if mask >> i & 1]
+
+
+BLOCKS = {key: SurveyBlock(key, spec) for key, spec in SURVEY.items()}
+BLOCKS_BY_CODE = {block.code: block for block in BLOCKS.values()}
+
+
+def deep_answer(block: SurveyBlock, mask: int):
+    if block.multi:
+        return block.labels(mask)
+    labels = block.labels(mask)
+    return labels[0] if labels else None
+
+# -------------------- Экспорт --------------------
+# поток записей -> плоская таблица: списки details и deep.block1..4 раскладываются в one-hot колонки
+EXPORT_CHUNK_BYTES = 45 * 1024 * 1024  # лимит Telegram на документ от бота — 50 МБ
+EXPORT_ROW_GROUP = 10000
+EXPORT_FORMATS = ("csv", "parquet")
+
+
+class ExportLayout:
+    """Колонки выгрузки, построенные по схеме опроса."""
+
+    BASE = ("time", "user_id", "photo", "rating", "city", "city_raw", "deep_completed")
+
+    def __init__(self):
+        self.columns = list(self.BASE)
+        self.detail_index = {}
+        for key in ("details_positive", "details_negative"):
+            for opt in BLOCKS[key].options:
+                # «Осанка» есть в обоих списках — колонка одна
+                if opt not in self.detail_index:
+                    self.detail_index[opt] = len(self.columns)
+                    self.columns.append(f"detail:{opt}")
+        self.other_details = len(self.columns)
+        self.columns.append("details_other")
+        self.deep_index = {}
+        for key in DEEP_BLOCKS:
+            for opt in BLOCKS[key].options:
+                self.deep_index[(key, opt)] = len(self.columns)
+                self.columns.append(f"{key}:{opt}")
+
+    def row(self, entry: dict) -> list:
+        ts = entry.get("ts")
+        deep = entry.get("deep")
+        row = [0] * len(self.columns)
+        row[:len(self.BASE)] = [
+            datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="seconds") if ts else "",
+            entry.get("user_id"),
+            entry.get("photo") or "",
+            entry.get("rating") or "",
+            entry.get("city") or "",
+            entry.get("city_raw") or "",
+            int(deep is not None),
+        ]
+        other = []
+        for opt in entry.get("details") or []:
+            idx = self.detail_index.get(opt)
+            if idx is None:
+                other.append(opt)
+            else:
+                row[idx] = 1
+        row[self.other_details] = "; ".join(other)
+        for key, answer in (deep or {}).items():
+            for opt in answer if isinstance(answer, list) else [answer]:
+                idx = self.deep_index.get((key, opt))
+                if idx is not None:
+                    row[idx] = 1
+        return row
+
+
+def parse_export_date(value: Optional[str], end: bool = False) -> Optional[float]:
+    # даты в UTC, конец периода включительно
+    if not value:
+        return None
+    day = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    if end:
+        day += timedelta(days=1)
+    return day.timestamp()
+
+
+def iter_export_entries(city: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None):
+    for entry in iter_results():
+        if city is not None and entry.get("city") != city:
+            continue
+        if since is not None or until is not None:
+            ts = entry.get("ts")
+            if ts is None or (since is not None and ts < since) or (until is not None and ts >= until):
+                continue
+        yield entry
+
+
+class CsvExportWriter:
+    suffix = ".csv"
+
+    def __init__(self, path: str, layout: ExportLayout):
+        self.layout = layout
+        self._f = open(path, "w", encoding="utf-8-sig", newline="")
+        self._csv = csv.writer(self._f)
+        self._csv.writerow(layout.columns)
+
+    def write(self, row: list):
+        self._csv.writerow(row)
+
+    def size(self) -> int:
+        return self._f.tell()
+
+    def close(self):
+        self._f.close()
+
+
+class ParquetExportWriter:
+    suffix = ".parquet"
+
+    def __init__(self, path: str, layout: ExportLayout):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Для Parquet нужен pyarrow: pip install pyarrow")
+        self._pa = pa
+        self.layout = layout
+        self.path = path
+        types = [pa.string(), pa.int64(), pa.string(), pa.string(), pa.string(), pa.string(), pa.int8()]
+        types += [pa.string() if i == layout.other_details else pa.int8() for i in range(len(layout.BASE), len(layout.columns))]
+        self.schema = pa.schema(list(zip(layout.columns, types)))
+        self._writer = pq.ParquetWriter(path, self.schema)
+        self._buffer = []
+
+    def write(self, row: list):
+        self._buffer.append(row)
+        if len(self._buffer) >= EXPORT_ROW_GROUP:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        columns = list(zip(*self._buffer))
+        self._writer.write_table(self._pa.Table.from_arrays(
+            [self._pa.array(col, type=field.type) for col, field in zip(columns, self.schema)], schema=self.schema))
+        self._buffer = []
+
+    def size(self) -> int:
+        return os.path.getsize(self.path)
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+EXPORT_WRITERS = {"csv": CsvExportWriter, "parquet": ParquetExportWriter}
+
+
+def export_results(base_path: str, fmt: str = "csv", city: Optional[str] = None, since: Optional[str] = None,
+                   until: Optional[str] = None, chunk_bytes: Optional[int] = None) -> List[str]:
+    """Пишет выгрузку потоково; при chunk_bytes режет на части. Возвращает пути файлов."""
+    writer_cls = EXPORT_WRITERS[fmt]
+    layout = ExportLayout()
+    base = base_path[:-len(writer_cls.suffix)] if base_path.endswith(writer_cls.suffix) else base_path
+    paths = []
+
+    def open_part():
+        path = f"{base}.part{len(paths) + 1}{writer_cls.suffix}" if chunk_bytes else base + writer_cls.suffix
+        paths.append(path)
+        return writer_cls(path, layout)
+
+    writer = open_part()
+    rows = part_rows = 0
+    if city is not None:
+        city = resolve_city(city)
+    try:
+        for entry in iter_export_entries(city, parse_export_date(since), parse_export_date(until, end=True)):
+            # размер проверяем раз в группу строк — для Parquet он меняется только при сбросе группы
+            if chunk_bytes and part_rows and part_rows % EXPORT_ROW_GROUP == 0 and writer.size() >= chunk_bytes:
+                writer.close()
+                writer = open_part()
+                part_rows = 0
+            writer.write(layout.row(entry))
+            rows += 1
+            part_rows += 1
+    finally:
+        writer.close()
+    logger.info("Экспорт: %d строк в %d файл(ов)", rows, len(paths))
+    return paths
+
+
+def parse_export_args(args: List[str]) -> dict:
+    """/export [csv|parquet] [city=Минск] [from=2024-01-01] [to=2024-01-31]"""
+    options = {"fmt": "csv", "city": None, "since": None, "until": None}
+    names = {"city": "city", "from": "since", "to": "until"}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep and key in EXPORT_FORMATS:
+            options["fmt"] = key
+        elif sep and key in names:
+            options[names[key]] = value
+        else:
+            raise ValueError(f"Непонятный аргумент: {arg}")
+    for key in ("since", "until"):
+        parse_export_date(options[key])
+    return options
+
+
+def compact_results():
+    store = get_results_store()
+    if not isinstance(store, ResultsLog):
+        raise SystemExit("Сжимается только журнал (RESULTS_BACKEND = \"jsonl\")")
+    before, after = store.compact()
+    # курсор снимка статистики — смещение в старом файле: пусть статистика пересчитается
+    try:
+        os.remove(stats_snapshot_path())
+    except FileNotFoundError:
+        pass
+    print(f"{store.path}: {before} -> {after} байт")
+
+
+# -------------------- Пакетный пересчёт --------------------
+# Офлайн-пересчёт по всей истории: хранилище читается кусками, каждая запись превращается в номера
+# (город, фото, оценка) и координаты выбранных вариантов, дальше всё считается векторно в NumPy.
+# Итог — тот же словарь, что ведёт PortraitStats (а значит, тот же отчёт, что /stats), плюс по городам:
+# распределение оценок, кросс-таблицы «оценка × деталь» и «оценка × вариант», совместный выбор деталей.
+BATCH_CHUNK = 50_000
+
+
+def require_numpy():
+    try:
+        import numpy as np
+    except ImportError:
+        raise RuntimeError("Для пакетного пересчёта нужен numpy: pip install numpy")
+    return np
+
+
+class Vocabulary:
+    """Подпись -> номер, в порядке первого появления."""
+
+    def __init__(self):
+        self.ids = {}
+        self.labels = []
+
+    def __call__(self, label) -> int:
+        idx = self.ids.get(label)
+        if idx is None:
+            idx = self.ids[label] = len(self.labels)
+            self.labels.append(label)
+        return idx
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+
+class ResultColumns:
+    """История в колонках: по элементу на запись и координаты (запись, вариант) для списков выбора."""
+
+    def __init__(self):
+        self.np = require_numpy()
+        self.cities = Vocabulary()
+        self.photos = Vocabulary()
+        self.ratings = Vocabulary()
+        self.details = Vocabulary()
+        self.blocks = Vocabulary()
+        # варианты глубоких блоков — пары (номер блока, подпись)
+        self.deep_options = Vocabulary()
+        self.rows = 0
+        self.cursor = None
+        # наборов вариантов немного (одни и те же комбинации повторяются), поэтому номера для них
+        # запоминаются целиком, а не ищутся по одному
+        self._detail_sets = {}
+        self._deep_sets = {}
+        self._chunks = {name: [] for name in ("city", "photo", "rating", "detail_rows", "detail_cols",
+                                              "block_rows", "block_cols", "deep_rows", "deep_cols")}
+
+    def extend(self, entries: List[dict]):
+        # подписи -> номера: единственный проход в Python, остальное — на массивах
+        city, photo, rating = [], [], []
+        detail_rows, detail_cols, block_rows, block_cols, deep_rows, deep_cols = [], [], [], [], [], []
+        row = self.rows
+        for entry in entries:
+            city.append(self.cities(entry.get("city") or "—"))
+            rating_label = entry.get("rating") or "—"
+            rating.append(self.ratings(rating_label))
+            photo.append(self.photos(entry.get("photo") or "—"))
+            details = entry.get("details")
+            if details:
+                key = tuple(details)
+                ids = self._detail_sets.get(key)
+                if ids is None:
+                    ids = self._detail_sets[key] = [self.details(opt) for opt in details]
+                detail_rows.extend([row] * len(ids))
+                detail_cols.extend(ids)
+            for block, answer in (entry.get("deep") or {}).items():
+                key = (block, tuple(answer) if isinstance(answer, list) else answer)
+                ids = self._deep_sets.get(key)
+                if ids is None:
+                    block_id = self.blocks(block)
+                    options = answer if isinstance(answer, list) else [answer]
+                    ids = self._deep_sets[key] = (block_id, [self.deep_options((block_id, opt))
+                                                             for opt in options if opt is not None])
+                block_rows.append(row)
+                block_cols.append(ids[0])
+                deep_rows.extend([row] * len(ids[1]))
+                deep_cols.extend(ids[1])
+            row += 1
+        self.rows = row
+        np = self.np
+        for name, values in (("city", city), ("photo", photo), ("rating", rating),
+                             ("detail_rows", detail_rows), ("detail_cols", detail_cols),
+                             ("block_rows", block_rows), ("block_cols", block_cols),
+                             ("deep_rows", deep_rows), ("deep_cols", deep_cols)):
+            self._chunks[name].append(np.asarray(values, dtype=np.int64))
+
+    def finish(self):
+        for name, chunks in self._chunks.items():
+            setattr(self, name, self.np.concatenate(chunks) if chunks else self.np.zeros(0, dtype=self.np.int64))
+        self._chunks = {}
+        return self
+
+
+def read_columns(store: Optional[ResultsStore] = None, chunk: int = BATCH_CHUNK) -> ResultColumns:
+    store = store or get_results_store()
+    cols = ResultColumns()
+    batch = []
+    for cursor, entry in store.iter_since():
+        batch.append(entry)
+        cols.cursor = cursor
+        if len(batch) >= chunk:
+            cols.extend(batch)
+            batch = []
+    if batch:
+        cols.extend(batch)
+    return cols.finish()
+
+
+def _ordered_counts(np, keys) -> list:
+    """[(ключ, число)] в порядке первого появления ключа — как растут словари в PortraitStats."""
+    if not len(keys):
+        return []
+    uniq, first, counts = np.unique(keys, return_index=True, return_counts=True)
+    order = np.argsort(first, kind="stable")
+    return list(zip(uniq[order].tolist(), counts[order].tolist()))
+
+
+def portrait_from_columns(cols: ResultColumns) -> dict:
+    """Словарь городов в формате PortraitStats.cities, посчитанный векторно."""
+    np = cols.np
+    C, P, R = len(cols.cities), len(cols.photos), len(cols.ratings)
+    V, B, O = len(cols.details), len(cols.blocks), len(cols.deep_options)
+    cities = {label: {"total": 0, "ratings": {}, "photos": {}, "details": {}, "deep": {}} for label in cols.cities.labels}
+    by_id = [cities[label] for label in cols.cities.labels]
+    for c, n in enumerate(np.bincount(cols.city, minlength=C).tolist()):
+        by_id[c]["total"] = n
+    for key, n in _ordered_counts(np, cols.city * R + cols.rating):
+        by_id[key // R]["ratings"][cols.ratings.labels[key % R]] = n
+    for key, n in _ordered_counts(np, (cols.city * P + cols.photo) * R + cols.rating):
+        pair, r = divmod(key, R)
+        c, p = divmod(pair, P)
+        by_id[c]["photos"].setdefault(cols.photos.labels[p], {})[cols.ratings.labels[r]] = n
+    for key, n in _ordered_counts(np, cols.city[cols.detail_rows] * V + cols.detail_cols):
+        by_id[key // V]["details"][cols.details.labels[key % V]] = n
+    for key, _ in _ordered_counts(np, cols.city[cols.block_rows] * B + cols.block_cols):
+        by_id[key // B]["deep"].setdefault(cols.blocks.labels[key % B], {})
+    for key, n in _ordered_counts(np, cols.city[cols.deep_rows] * O + cols.deep_cols):
+        block_id, opt = cols.deep_options.labels[key % O]
+        by_id[key // O]["deep"][cols.blocks.labels[block_id]][opt] = n
+    return cities
+
+
+def _analyse_city(args) -> dict:
+    """Матрицы одного города; вынесено на уровень модуля, чтобы работать в пуле процессов."""
+    np = require_numpy()
+    rating, detail_rows, detail_cols, deep_rows, deep_cols, R, V, O = args
+    n = len(rating)
+    onehot_details = np.zeros((n, V), dtype=np.int32)
+    np.add.at(onehot_details, (detail_rows, detail_cols), 1)
+    onehot_rating = np.zeros((n, R), dtype=np.int32)
+    onehot_rating[np.arange(n), rating] = 1
+    onehot_deep = np.zeros((n, O), dtype=np.int32)
+    np.add.at(onehot_deep, (deep_rows, deep_cols), 1)
+    return {
+        "ratings": np.bincount(rating, minlength=R),
+        "rating_x_detail": onehot_rating.T @ onehot_details,
+        "rating_x_deep": onehot_rating.T @ onehot_deep,
+        "detail_cooccurrence": onehot_details.T @ onehot_details,
+    }
+
+
+def analyse_columns(cols: ResultColumns, cities: Optional[List[str]] = None, workers: int = 0) -> dict:
+    """Кросс-таблицы по городам; workers > 1 — города считаются в пуле процессов."""
+    np = cols.np
+    R, V, O = len(cols.ratings), len(cols.details), len(cols.deep_options)
+    names = cities if cities is not None else cols.cities.labels
+    # одна стабильная сортировка по городу вместо прохода по всем записям на каждый город:
+    # записи города и их выборы лежат подряд, номер записи внутри города — позиция минус начало отрезка
+    C = len(cols.cities)
+    order = np.argsort(cols.city, kind="stable")
+    bounds = np.searchsorted(cols.city[order], np.arange(C + 1))
+    position = np.empty(cols.rows, dtype=np.int64)
+    position[order] = np.arange(cols.rows)
+
+    def grouped(rows, values):
+        city = cols.city[rows]
+        by_city = np.argsort(city, kind="stable")
+        return position[rows[by_city]], values[by_city], np.searchsorted(city[by_city], np.arange(C + 1))
+
+    detail_local, detail_cols, detail_bounds = grouped(cols.detail_rows, cols.detail_cols)
+    deep_local, deep_cols, deep_bounds = grouped(cols.deep_rows, cols.deep_cols)
+    empty = np.zeros(0, dtype=np.int64)
+    jobs = []
+    for name in names:
+        c = cols.cities.ids.get(name)
+        if c is None:
+            jobs.append((empty, empty, empty, empty, empty, R, V, O))
+            continue
+        start = bounds[c]
+        d = slice(detail_bounds[c], detail_bounds[c + 1])
+        q = slice(deep_bounds[c], deep_bounds[c + 1])
+        jobs.append((cols.rating[order[start:bounds[c + 1]]], detail_local[d] - start, detail_cols[d],
+                     deep_local[q] - start, deep_cols[q], R, V, O))
+    if workers > 1 and len(jobs) > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results = list(pool.map(_analyse_city, jobs))
+    else:
+        results = [_analyse_city(job) for job in jobs]
+
+    ratings, details = cols.ratings.labels, cols.details.labels
+    deep = [f"{cols.blocks.labels[b]}:{opt}" for b, opt in cols.deep_options.labels]
+    out = {}
+    for name, res in zip(names, results):
+        total = int(res["ratings"].sum())
+        out[name] = {
+            "total": total,
+            "ratings": dict(zip(ratings, res["ratings"].tolist())),
+            "rating_share": {r: round(n / total, 4) if total else 0.0 for r, n in zip(ratings, res["ratings"].tolist())},
+            "rating_x_detail": {r: dict(zip(details, row)) for r, row in zip(ratings, res["rating_x_detail"].tolist())},
+            "rating_x_deep": {r: dict(zip(deep, row)) for r, row in zip(ratings, res["rating_x_deep"].tolist())},
+            "detail_cooccurrence": {"labels": details, "matrix": res["detail_cooccurrence"].tolist()},
+        }
+    return out
+
+
+def reaggregate(city: Optional[str] = None, workers: int = 0, output: Optional[str] = None,
+                snapshot: bool = False) -> str:
+    """Пересчёт портрета по всей истории; возвращает отчёт в том же виде, что /stats."""
+    store = get_results_store()
+    started = time.perf_counter()
+    cols = read_columns(store)
+    stats = PortraitStats()
+    stats.cities = portrait_from_columns(cols)
+    stats.cursor = cols.cursor
+    stats.store_id = getattr(store, "path", None)
+    logger.info("Пересчёт: %d записей, %d городов за %.2f с", cols.rows, len(stats.cities), time.perf_counter() - started)
+    cities = [resolve_city(city)] if city else sorted(stats.cities, key=lambda c: -stats.cities[c]["total"])
+    if output:
+        write_file_atomic(output, json.dumps(analyse_columns(cols, cities, workers), ensure_ascii=False))
+    if snapshot:
+        # бот подхватит пересчитанные счётчики при следующем запуске и догонит хранилище с курсора
+        write_file_atomic(stats_snapshot_path(), stats.snapshot())
+    return "\n\n".join(stats.report(name) for name in cities)
+
+
+# -------------------- Клавиатуры --------------------
+# все клавиатуры статичны — собираем один раз
+MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔥 Оценить фото", callback_data="menu_rate")],
+    [InlineKeyboardButton("❓ Что за эксперимент?", callback_data="menu_about")],
+])
+ABOUT_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="menu_back")]])
+RATING_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton(RATINGS["rate_1"], callback_data="rate_1"),
+        InlineKeyboardButton(RATINGS["rate_2"], callback_data="rate_2"),
+    ],
+    [
+        InlineKeyboardButton(RATINGS["rate_3"], callback_data="rate_3"),
+        InlineKeyboardButton(RATINGS["rate_4"], callback_data="rate_4"),
+    ],
+])
+CITY_KEYBOARD = BLOCKS["city"].keyboard()
+INVITE_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🔥 Да, хочу", callback_data="invite_yes"),
+      InlineKeyboardButton("❌ Нет, спасибо", callback_data="invite_no")]]
+)
+CHANNEL_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("📊 Перейти в канал", url="https://t.me/sam_tich")]])
+
+def build_menu_keyboard() -> InlineKeyboardMarkup:
+    return MENU_KEYBOARD
+
+def build_about_keyboard() -> InlineKeyboardMarkup:
+    return ABOUT_KEYBOARD
+
+def build_rating_keyboard() -> InlineKeyboardMarkup:
+    return RATING_KEYBOARD
+
+# -------------------- Уведомления админам --------------------
+# отправка идёт в фоне: пользователь не ждёт доставку админам
+NOTIFY_QUEUE_SIZE = 5000
+# 1 — каждое сообщение отдельно; >1 — дайджест из N ответов или за NOTIFY_DIGEST_INTERVAL секунд
+NOTIFY_DIGEST_SIZE = 1
+NOTIFY_DIGEST_INTERVAL = 30.0
+# лимиты Telegram: ~1 сообщение/с в один чат и ~30/с на бота
+NOTIFY_PER_CHAT_RATE = 1.0
+NOTIFY_GLOBAL_RATE = 25.0
+NOTIFY_RETRIES = 5
+TELEGRAM_TEXT_LIMIT = 4096
+
+
+class TokenBucket:
+    """Токен-бакет: rate токенов в секунду, не больше burst подряд."""
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.monotonic()
+
+    def take(self) -> float:
+        """Забирает токен; возвращает, сколько секунд нужно подождать (0 — можно сразу)."""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def try_take(self) -> bool:
+        """Забирает токен, только если он есть; в долг не уходит."""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def acquire(self):
+        delay = self.take()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def format_admin_entry(entry: dict) -> str:
+    return (
+        f"Пользователь ID: {entry.get('user_id')}\n\n"
+        f"Фото: {entry.get('photo')}\n"
+        f"Оценка: {entry.get('rating')}\n"
+        f"Детали: {', '.join(entry.get('details') or [])}\n"
+        f"Город: {entry.get('city')}\n"
+        f"Глубокие ответы: {json.dumps(entry.get('deep'), ensure_ascii=False)}"
+    )
+
+
+def format_admin_digest(entries: List[dict]) -> List[str]:
+    if len(entries) == 1:
+        return ["Новый ответ:\n" + format_admin_entry(entries[0])]
+    # дайджест режем на сообщения по лимиту Telegram
+    messages, current = [], f"Новые ответы ({len(entries)}):"
+    for entry in entries:
+        part = "\n\n— " + format_admin_entry(entry)
+        if len(current) + len(part) > TELEGRAM_TEXT_LIMIT:
+            messages.append(current)
+            current = part.lstrip()
+        else:
+            current += part
+    messages.append(current)
+    return messages
 
-def save_result(entry: dict):
-    data = load_results()
-    data.append(entry)
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
 
-def get_photo_for_user(user_id: int) -> str:
-    if not PHOTO_IDS:
-        return ""
-    return PHOTO_IDS[user_id % len(PHOTO_IDS)]
+class AdminNotifier:
+    """Фоновая рассылка админам: дайджесты, лимиты на чат и на бота, повтор при RetryAfter."""
 
-# -------------------- Клавиатуры --------------------
-def build_menu_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton("🔥 Оценить фото", callback_data="menu_rate")],
-        [InlineKeyboardButton("❓ Что за эксперимент?", callback_data="menu_about")],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    def __init__(self, digest_size: int = NOTIFY_DIGEST_SIZE, digest_interval: float = NOTIFY_DIGEST_INTERVAL):
+        self.digest_size = digest_size
+        self.digest_interval = digest_interval
+        self.bot = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._outboxes = {}
+        self._tasks = []
+        self._global = TokenBucket(NOTIFY_GLOBAL_RATE, burst=NOTIFY_GLOBAL_RATE)
+        self.delivered = 0
+        self.dropped = 0
+        self.retries = 0
 
-def build_about_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="menu_back")]])
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
 
-def build_rating_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [
-        [
-            InlineKeyboardButton("❤️ Нравится", callback_data="rate_1"),
-            InlineKeyboardButton("💛 Скорее нравится", callback_data="rate_2"),
-        ],
-        [
-            InlineKeyboardButton("💙 Скорее не нравится", callback_data="rate_3"),
-            InlineKeyboardButton("💔 Не нравится", callback_data="rate_4"),
-        ],
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-def multi_select_keyboard(options: List[str], selected: List[str], allow_skip=True) -> InlineKeyboardMarkup:
-    kb = []
-    for opt in options:
-        mark = "✅ " if opt in selected else ""
-        kb.append([InlineKeyboardButton(f"{mark}{opt}", callback_data=f"toggle::{opt}")])
-    bottom = [InlineKeyboardButton("➡️ Пропустить", callback_data="details_next")] if allow_skip else [InlineKeyboardButton("➡️ Дальше", callback_data="details_next")]
-    kb.append(bottom)
-    return InlineKeyboardMarkup(kb)
-
-def single_choice_keyboard(options: List[str]) -> InlineKeyboardMarkup:
-    kb = [[InlineKeyboardButton(opt, callback_data=f"city::{opt}")] for opt in options]
-    kb.append([InlineKeyboardButton("Другой город", callback_data="city::OTHER")])
-    return InlineKeyboardMarkup(kb)
-
-def deep_multiselect_keyboard(options: List[str], selected: List[str]) -> InlineKeyboardMarkup:
-    kb = []
-    for opt in options:
-        mark = "✅ " if opt in selected else ""
-        kb.append([InlineKeyboardButton(f"{mark}{opt}", callback_data=f"deep_toggle::{opt}")])
-    kb.append([InlineKeyboardButton("➡️ Дальше", callback_data="deep_next")])
-    return InlineKeyboardMarkup(kb)
+    def start(self, bot):
+        if self.running:
+            return
+        self.bot = bot
+        self._queue = asyncio.Queue(NOTIFY_QUEUE_SIZE)
+        self._tasks.append(asyncio.create_task(self._collect(), name="admin_digest"))
+        # у каждого админа свой воркер — медленный чат не задерживает остальных
+        for admin in ADMIN_IDS:
+            outbox = self._outboxes[admin] = asyncio.Queue(NOTIFY_QUEUE_SIZE)
+            self._tasks.append(asyncio.create_task(self._deliver(admin, outbox), name=f"admin_{admin}"))
+
+    def submit(self, entry: dict):
+        try:
+            self._queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning("Очередь уведомлений переполнена, ответ не отправлен админам")
+
+    async def _collect(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.digest_interval
+            while len(batch) < self.digest_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            for text in format_admin_digest(batch):
+                for admin, outbox in self._outboxes.items():
+                    try:
+                        outbox.put_nowait(text)
+                    except asyncio.QueueFull:
+                        self.dropped += 1
+                        logger.warning("Очередь админа %s переполнена, сообщение пропущено", admin)
+            for _ in batch:
+                self._queue.task_done()
+
+    async def _deliver(self, chat_id: int, outbox: asyncio.Queue):
+        bucket = TokenBucket(NOTIFY_PER_CHAT_RATE)
+        while True:
+            text = await outbox.get()
+            try:
+                await self._send(chat_id, text, bucket)
+            finally:
+                outbox.task_done()
+
+    async def _send(self, chat_id: int, text: str, bucket: TokenBucket):
+        for attempt in range(NOTIFY_RETRIES):
+            await bucket.acquire()
+            await self._global.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                self.delivered += 1
+                return
+            except RetryAfter as e:
+                delay = e.retry_after
+                delay = delay.total_seconds() if hasattr(delay, "total_seconds") else delay
+                self.retries += 1
+                logger.warning("RetryAfter %s с для админа %s", delay, chat_id)
+                await asyncio.sleep(delay)
+            except (TimedOut, NetworkError):
+                self.retries += 1
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except Exception:
+                logger.exception("Не удалось отправить админу %s", chat_id)
+                return
+        self.dropped += 1
+        logger.error("Сообщение админу %s не доставлено после %d попыток", chat_id, NOTIFY_RETRIES)
+
+    async def stop(self, timeout: float = 10.0):
+        if not self.running:
+            return
+        try:
+            # дожидаемся, пока разойдётся уже поставленное в очередь
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не все уведомления админам успели уйти до остановки")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._outboxes.clear()
+
+    async def _drain(self):
+        # незаполненный дайджест не ждём — отправляем сразу
+        self.digest_interval = 0
+        await self._queue.join()
+        for outbox in self._outboxes.values():
+            await outbox.join()
+
+
+admin_notifier = AdminNotifier()
+
+
+# -------------------- Правки клавиатур --------------------
+# быстрые нажатия в мультивыборе: состояние меняем сразу, а правку клавиатуры откладываем
+# и отправляем только последнюю
+EDIT_DEBOUNCE = 0.3
+EDIT_MEMORY_SIZE = 10000
+
+
+class MarkupCoalescer:
+    """Debounce правок reply_markup по сообщениям; одинаковые клавиатуры повторно не отправляются."""
+
+    def __init__(self, delay: float = EDIT_DEBOUNCE, memory: int = EDIT_MEMORY_SIZE):
+        self.delay = delay
+        self.memory = memory
+        self._pending = {}
+        self._tasks = {}
+        # сообщения, правка которых уже отправлена в Bot API и ещё не вернулась -> Event её завершения
+        self._in_flight = {}
+        # что сейчас видит пользователь — чтобы не слать ту же клавиатуру повторно
+        self._shown = OrderedDict()
+        self.requested = 0
+        self.sent = 0
+        self.identical = 0
+        self.failed = 0
+
+    @property
+    def saved(self) -> int:
+        return self.requested - self.sent - self.failed - len(self._pending)
+
+    def shown(self, chat_id: int, message_id: int, markup: InlineKeyboardMarkup):
+        key = (chat_id, message_id)
+        self._shown[key] = markup
+        self._shown.move_to_end(key)
+        while len(self._shown) > self.memory:
+            self._shown.popitem(last=False)
+
+    def schedule(self, bot, chat_id: int, message_id: int, markup: InlineKeyboardMarkup):
+        key = (chat_id, message_id)
+        self.requested += 1
+        self._pending[key] = markup
+        # на сообщение одна задача: пока она жива, она же отправит и новую клавиатуру — правки не обгоняют друг друга
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._flush_later(bot, key))
+
+    async def discard(self, chat_id: int, message_id: int):
+        # сообщение переходит к следующему шагу — отложенная правка больше не нужна
+        key = (chat_id, message_id)
+        self._pending.pop(key, None)
+        self._shown.pop(key, None)
+        task = self._tasks.get(key)
+        if task is None:
+            return
+        done = self._in_flight.get(key)
+        if done is not None:
+            # запрос уже ушёл в Bot API, отменять поздно: дожидаемся только его (не всей задачи с её
+            # следующей паузой), чтобы следующий шаг лёг поверх
+            await done.wait()
+        else:
+            self._tasks.pop(key, None)
+            task.cancel()
+
+    async def _flush_later(self, bot, key):
+        try:
+            while True:
+                await asyncio.sleep(self.delay)
+                markup = self._pending.pop(key, None)
+                if markup is None:
+                    return
+                done = self._in_flight[key] = asyncio.Event()
+                try:
+                    await self._edit(bot, key, markup)
+                finally:
+                    del self._in_flight[key]
+                    done.set()
+                if key not in self._pending:
+                    return
+        except asyncio.CancelledError:
+            return
+        finally:
+            if self._tasks.get(key) is asyncio.current_task():
+                del self._tasks[key]
+
+    async def _edit(self, bot, key, markup: InlineKeyboardMarkup):
+        # клавиатуры берутся из кэша блока, так что одинаковое состояние — тот же объект
+        current = self._shown.get(key)
+        if current is markup or current == markup:
+            self.identical += 1
+            return
+        try:
+            await bot.edit_message_reply_markup(chat_id=key[0], message_id=key[1], reply_markup=markup)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                self.identical += 1
+                self.shown(key[0], key[1], markup)
+                return
+            self.failed += 1
+            logger.warning("Не удалось обновить клавиатуру %s: %s", key, e)
+            return
+        except Exception:
+            self.failed += 1
+            logger.exception("Не удалось обновить клавиатуру %s", key)
+            return
+        self.sent += 1
+        self.shown(key[0], key[1], markup)
+
+    def close(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        self._pending.clear()
+        logger.info("Правки клавиатур: запрошено %d, отправлено %d, сэкономлено %d",
+                    self.requested, self.sent, self.saved)
+
+
+markup_edits = MarkupCoalescer()
+
+
+async def update_markup(update: Update, context: ContextTypes.DEFAULT_TYPE, markup: InlineKeyboardMarkup):
+    message = update.callback_query.message
+    if message is None:
+        await update.callback_query.edit_message_reply_markup(reply_markup=markup)
+        return
+    markup_edits.schedule(context.bot, message.chat_id, message.message_id, markup)
+
+
+async def leave_message(update: Update):
+    message = update.callback_query.message if update.callback_query else None
+    if message is not None:
+        await markup_edits.discard(message.chat_id, message.message_id)
+
+
+def remember_markup(message, markup: InlineKeyboardMarkup):
+    if message is not None:
+        markup_edits.shown(message.chat_id, message.message_id, markup)
 
 # -------------------- Обработчики --------------------
+def is_admin(update: Update) -> bool:
+    return update.effective_user is not None and update.effective_user.id in ADMIN_IDS
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Стартовое сообщение — главное меню."""
     user = update.effective_user
     context.user_data.clear()
     context.user_data["uid"] = user.id
+    # сессия = один проход опроса; по ней отсекаем повторное завершение
+    context.user_data["session"] = secrets.token_hex(4)
     text = (
         "Привет! Это эксперимент «Самцыч».\n\n"
         "Здесь ты можешь анонимно оценить фото и помочь собрать \n\n"
@@ -133,7 +2944,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    logger.info("menu_callback: %s", query.data)
     data = query.data
 
     if data == "menu_about":
@@ -150,10 +2960,11 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return START_MENU
 
     if data == "menu_rate":
-        uid = context.user_data.get("uid", 0)
-
-        # берём две фотки
-        photos = PHOTO_IDS[:2]   # первые две из списка
+        # берём следующие фото по кругу — показы распределяются поровну
+        photos = photo_catalogue.next_album()
+        if not photos:
+            await query.edit_message_text("Фото пока нет, загляни позже.", reply_markup=build_menu_keyboard())
+            return START_MENU
 
         # удаляем сообщение с меню
         try:
@@ -162,19 +2973,19 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
         # отправляем альбом
-        album = [
-            InputMediaPhoto(media=p, caption="Оцени фото 👇\n\nТвой выбор анонимен." if i == 0 else None)
-            for i, p in enumerate(photos)
-        ]
+        album = [p.media(ALBUM_CAPTION if i == 0 else None) for i, p in enumerate(photos)]
 
         sent_messages = await context.bot.send_media_group(
             chat_id=query.message.chat_id,
             media=album
         )
 
+        if photo_catalogue.remember_uploads(photos, sent_messages):
+            await asyncio.to_thread(write_file_atomic, photo_catalogue.cache_path, photo_catalogue.cache_snapshot())
+
         # сохраняем id первой фотки (к которой будет прикреплена оценка)
         main_photo_msg_id = sent_messages[0].message_id
-        context.user_data["current_photo"] = photos[0]
+        context.user_data["current_photo"] = photos[0].id
         context.user_data["photo_message_id"] = main_photo_msg_id
 
         # отправляем кнопки отдельным сообщением
@@ -192,298 +3003,271 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def rating_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    logger.info("rating_callback: %s", query.data)
     data = query.data
-    if not data.startswith("rate_"):
+    if data not in RATINGS:
         await query.edit_message_text("Непонятная команда.")
         return START_MENU
 
-    rating_map = {
-        "rate_1": "❤️ Нравится",
-        "rate_2": "💛 Скорее нравится",
-        "rate_3": "💙 Скорее не нравится",
-        "rate_4": "💔 Не нравится",
-    }
-    rating_label = rating_map.get(data, "Неизвестно")
-    context.user_data["rating"] = rating_label
-
-    if data in ("rate_1", "rate_2"):
-        options = ["🙂 Улыбка", "👀 Глаза", "🌿 Вайб / энергетика", "👔 Стиль одежды",
-                   "🙂 Черты лица", "💪 Телосложение", "🧍‍♂️ Осанка", "⭐️ Просто понравился"]
-        context.user_data["details_positive_options"] = options
-        context.user_data["details_selected"] = []
-        # пытаемся редактировать подпись к фото, если не выйдет — отправим новое сообщение
-        try:
-            await query.edit_message_caption(
-                caption=f"Ты выбрал: {rating_label}\n\nА что понравилось больше всего? Можно выбрать несколько вариантов.",
-                reply_markup=multi_select_keyboard(options, []),
-            )
-        except Exception:
-            await context.bot.send_message(chat_id=query.message.chat_id,
-                                           text=f"Ты выбрал: {rating_label}\n\nА что понравилось больше всего? Можно выбрать несколько вариантов.",
-                                           reply_markup=multi_select_keyboard(options, []))
-        return AFTER_RATING
-    else:
-        options = ["👔 Стиль", "🙂 Лицо / мимика", "🧍‍♂️ Осанка", "🧢 Прическа / волосы",
-                   "🤷 Не мой типаж", "🔞 Слишком молодой", "📅 Слишком взрослый", "❌ Просто не зашёл"]
-        context.user_data["details_negative_options"] = options
-        context.user_data["details_selected"] = []
-        try:
-            await query.edit_message_caption(
-                caption=f"Ты выбрал: {rating_label}\n\nА что больше всего не зашло? Можно выбрать несколько вариантов.",
-                reply_markup=multi_select_keyboard(options, []),
-            )
-        except Exception:
-            await context.bot.send_message(chat_id=query.message.chat_id,
-                                           text=f"Ты выбрал: {rating_label}\n\nА что больше всего не зашло? Можно выбрать несколько вариантов.",
-                                           reply_markup=multi_select_keyboard(options, []))
-        return AFTER_RATING
+    rating_label = RATINGS[data]
+    context.user_data["rating"] = data
+    block = BLOCKS["details_positive" if data in POSITIVE_RATINGS else "details_negative"]
+    context.user_data["details_block"] = block.key
+    context.user_data["details_mask"] = 0
+    text = block.prompt.format(rating=rating_label)
+    # пытаемся редактировать подпись к фото, если не выйдет — отправим новое сообщение
+    try:
+        await query.edit_message_caption(caption=text, reply_markup=block.keyboard())
+        message = query.message
+    except Exception:
+        message = await context.bot.send_message(chat_id=query.message.chat_id, text=text, reply_markup=block.keyboard())
+    remember_markup(message, block.keyboard())
+    return AFTER_RATING
 
-async def details_toggle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def details_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: SurveyCallback):
+    mask = context.user_data.get("details_mask", 0) ^ (1 << cb.option)
+    context.user_data["details_mask"] = mask
+    await update_markup(update, context, cb.block.keyboard(mask))
+    return AFTER_RATING
+
+async def details_next(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: SurveyCallback):
+    # переход к выбору города
     query = update.callback_query
-    await query.answer()
-    logger.info("details_toggle_callback: %s", query.data)
-    data = query.data
+    await leave_message(update)
+    text = BLOCKS["city"].prompt
+    try:
+        await query.edit_message_caption(caption=text, reply_markup=CITY_KEYBOARD)
+    except Exception:
+        await context.bot.send_message(chat_id=query.message.chat_id, text=text, reply_markup=CITY_KEYBOARD)
+    return CITY_CHOICE
 
-    if data == "details_next":
-        # переход к выбору города
-        try:
-            await query.edit_message_caption(
-                caption="Спасибо! Теперь, из какого ты города? Это нужно, чтобы собрать карту предпочтений.",
-                reply_markup=single_choice_keyboard(["Минск", "Гродно", "Гомель", "Могилёв", "Брест"]),
-            )
-        except Exception:
-            await context.bot.send_message(chat_id=query.message.chat_id,
-                                           text="Спасибо! Теперь, из какого ты города? Это нужно, чтобы собрать карту предпочтений.",
-                                           reply_markup=single_choice_keyboard(["Минск", "Гродно", "Гомель", "Могилёв", "Брест"]))
-        return CITY_CHOICE
+DETAILS_ACTIONS = {ACTION_TOGGLE: details_toggle, ACTION_NEXT: details_next}
 
-    if data.startswith("toggle::"):
-        opt = data.split("::", 1)[1]
-        sel = context.user_data.get("details_selected", [])
-        if opt in sel:
-            sel.remove(opt)
-        else:
-            sel.append(opt)
-        context.user_data["details_selected"] = sel
-        options = context.user_data.get("details_positive_options") or context.user_data.get("details_negative_options") or []
-        try:
-            await query.edit_message_reply_markup(reply_markup=multi_select_keyboard(options, sel))
-        except Exception:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Обновлено.", reply_markup=multi_select_keyboard(options, sel))
+async def details_toggle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    cb = decode_callback(query.data)
+    if cb is None or cb.block.key != context.user_data.get("details_block"):
+        await query.answer("Неизвестная команда в деталях.")
         return AFTER_RATING
+    return await DETAILS_ACTIONS[cb.action](update, context, cb)
 
-    await query.answer("Неизвестная команда в деталях.")
-    return AFTER_RATING
+def selected_details(context: ContextTypes.DEFAULT_TYPE) -> List[str]:
+    block = BLOCKS[context.user_data.get("details_block", "details_positive")]
+    return block.labels(context.user_data.get("details_mask", 0))
 
 async def city_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    logger.info("city_callback: %s", query.data)
-    data = query.data
-    if not data.startswith("city::"):
+    cb = decode_callback(query.data)
+    if cb is None or cb.block.key != "city":
         await query.answer("Ошибка выбора города")
         return CITY_CHOICE
-    city = data.split("::", 1)[1]
-    if city == "OTHER":
-        # просим текстовый ввод
+    if cb.action == ACTION_NEXT:
+        # «Другой город» — просим текстовый ввод
         try:
             await query.edit_message_text("Напиши, пожалуйста, название твоего города (текстово).")
         except Exception:
             await context.bot.send_message(chat_id=query.message.chat_id, text="Напиши, пожалуйста, название твоего города (текстово).")
         return OTHER_CITY
     else:
-        context.user_data["city"] = city
-        context.user_data["details"] = context.user_data.get("details_selected", [])
+        context.user_data["city"] = cb.block.options[cb.option]
+        context.user_data.pop("city_raw", None)
+        text = "Можешь помочь составить образ своего идеального парня?✨\nМини-опрос — 20–30 секунд. Можно выбрать несколько вариантов."
         try:
-            await query.edit_message_text(
-                "Можешь помочь составить образ своего идеального парня?✨\nМини-опрос — 20–30 секунд. Можно выбрать несколько вариантов.",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🔥 Да, хочу", callback_data="invite_yes"),
-                      InlineKeyboardButton("❌ Нет, спасибо", callback_data="invite_no")]]
-                ),
-            )
+            await query.edit_message_text(text, reply_markup=INVITE_KEYBOARD)
         except Exception:
-            await context.bot.send_message(chat_id=query.message.chat_id,
-                                           text="Можешь помочь составить образ своего идеального парня?✨\nМини-опрос — 20–30 секунд. Можно выбрать несколько вариантов.",
-                                           reply_markup=InlineKeyboardMarkup(
-                                               [[InlineKeyboardButton("🔥 Да, хочу", callback_data="invite_yes"),
-                                                 InlineKeyboardButton("❌ Нет, спасибо", callback_data="invite_no")]]
-                                           ))
+            await context.bot.send_message(chat_id=query.message.chat_id, text=text, reply_markup=INVITE_KEYBOARD)
         return INVITE_DEEP
 
 async def other_city_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
-    logger.info("other_city_text: %s", text)
-    context.user_data["city"] = text
-    context.user_data["details"] = context.user_data.get("details_selected", [])
+    # канонический город — сразу, чтобы статистика не делилась на «минск», «Minsk» и «Мінск»
+    context.user_data["city"] = resolve_city(text)
+    context.user_data["city_raw"] = text
     await update.message.reply_text(
-        "Можешь помочь составить образ своего идеального парня?✨\nММини-опрос — 20–30 секунд. Можно выбрать несколько вариантов.",
-        reply_markup=InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🔥 Да, хочу", callback_data="invite_yes"),
-              InlineKeyboardButton("❌ Нет, спасибо", callback_data="invite_no")]]
-        ),
+        "Можешь помочь составить образ своего идеального парня?✨\nМини-опрос — 20–30 секунд. Можно выбрать несколько вариантов.",
+        reply_markup=INVITE_KEYBOARD,
     )
     return INVITE_DEEP
 
+async def complete_survey(update: Update, context: ContextTypes.DEFAULT_TYPE, deep: bool):
+    keys = completion_keys(update, context)
+    entry = build_entry(context, deep=deep)
+    # опрос закончен — состояние пользователя больше не нужно ни в памяти, ни в хранилище
+    context.user_data.clear()
+    if not await completion_index.claim(keys):
+        # повтор: ни записи, ни уведомления админам
+        logger.debug("Повторное завершение опроса отброшено: %s", keys)
+        return
+    if not abuse_guard.record_completion(update.effective_user.id, entry["photo"]):
+        logger.debug("Лимит завершений по фото: %s %s", update.effective_user.id, entry["photo"])
+        return
+    await enqueue_result(entry)
+    await notify_admins(context, entry)
+
 async def invite_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    logger.info("invite_callback: %s", query.data)
     data = query.data
     if data == "invite_no":
-        entry = {
-            "user_id": context.user_data.get("uid"),
-            "photo": context.user_data.get("current_photo"),
-            "rating": context.user_data.get("rating"),
-            "details": context.user_data.get("details", []),
-            "city": context.user_data.get("city"),
-            "deep": None,
-        }
-        save_result(entry)
-        await notify_admins(context, entry)
-        await query.edit_message_text("Спасибо! Твои ответы уйдут в «Самцыч» и помогут создать портрет\n\nидеального парня в твоём городе.\n\nКнопка: 📊 Перейти в канал", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📊 Перейти в канал", url="https://t.me/sam_tich")]]))
+        await complete_survey(update, context, deep=False)
+        await query.edit_message_text("Спасибо! Твои ответы уйдут в «Самцыч» и помогут создать портрет\n\nидеального парня в твоём городе.\n\nКнопка: 📊 Перейти в канал", reply_markup=CHANNEL_KEYBOARD)
         return ConversationHandler.END
 
     if data == "invite_yes":
-        context.user_data.setdefault("deep", {})
-        options = [
-            "Мягкие черты", "Выраженные скулы", "Широкая челюсть", "Узкое лицо", "Круглое лицо",
-            "Светлая кожа", "Тёмная кожа", "Волосы: короткие", "Волосы: длинные", "Не важно"
-        ]
-        context.user_data["deep_block1_selected"] = []
-        await query.edit_message_text("Какие черты лица тебе нравятся? Выбери всё, что подходит.", reply_markup=deep_multiselect_keyboard(options, []))
-        return DEEP_BLOCK1
+        context.user_data["deep"] = {}
+        block = BLOCKS[DEEP_FIRST_BLOCK]
+        context.user_data["deep_block"] = block.key
+        context.user_data["deep_mask"] = 0
+        await query.edit_message_text(block.prompt, reply_markup=block.keyboard())
+        remember_markup(query.message, block.keyboard())
+        return block.state
 
     await query.answer("Неизвестная команда.")
     return INVITE_DEEP
 
-async def deep_toggle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def deep_advance(update: Update, context: ContextTypes.DEFAULT_TYPE, block: SurveyBlock, mask: int):
     query = update.callback_query
-    await query.answer()
-    logger.info("deep_toggle_callback: %s", query.data)
-    data = query.data
+    await leave_message(update)
+    context.user_data.setdefault("deep", {})[block.key] = mask
 
-    # блок 1
-    if data.startswith("deep_toggle::") and context.user_data.get("deep_block1_selected") is not None:
-        opt = data.split("::", 1)[1]
-        sel = context.user_data.get("deep_block1_selected", [])
-        if opt in sel:
-            sel.remove(opt)
-        else:
-            sel.append(opt)
-        context.user_data["deep_block1_selected"] = sel
-        options = [
-            "Мягкие черты", "Выраженные скулы", "Широкая челюсть", "Узкое лицо", "Круглое лицо",
-            "Светлая кожа", "Тёмная кожа", "Волосы: короткие", "Волосы: длинные", "Не важно"
-        ]
-        try:
-            await query.edit_message_reply_markup(reply_markup=deep_multiselect_keyboard(options, sel))
-        except Exception:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Обновлено.", reply_markup=deep_multiselect_keyboard(options, sel))
-        return DEEP_BLOCK1
-
-    if data == "deep_next" and context.user_data.get("deep_block1_selected") is not None:
-        context.user_data["deep"]["block1"] = context.user_data.get("deep_block1_selected", [])
-        options2 = ["Худощавый", "Средний", "Спортивный", "Крепкий", "Не важно"]
-        kb2 = InlineKeyboardMarkup([[InlineKeyboardButton(opt, callback_data=f"deep2::{opt}")] for opt in options2] + [[InlineKeyboardButton("➡️ Дальше", callback_data="deep2_next")]])
-        await query.edit_message_text("Какое телосложение тебе ближе?", reply_markup=kb2)
-        context.user_data.pop("deep_block1_selected", None)
-        return DEEP_BLOCK2
-
-    # блок 2
-    if data.startswith("deep2::"):
-        choice = data.split("::", 1)[1]
-        context.user_data["deep"]["block2"] = choice
-        options3 = ["Кежуал", "Спортивный", "Офисный (рубашка/пиджак)", "Уличный / streetwear",
-                    "Минимализм", "Творческий", "Гранж / рок", "Брутальный", "Аккуратный, ухоженный", "Не важно"]
-        context.user_data["deep_block3_selected"] = []
-        await query.edit_message_text("В каком стиле парень выглядит привлекательнее?", reply_markup=deep_multiselect_keyboard(options3, []))
-        return DEEP_BLOCK3
-
-    # блок 3
-    if data.startswith("deep_toggle::") and context.user_data.get("deep_block3_selected") is not None:
-        opt = data.split("::", 1)[1]
-        sel = context.user_data.get("deep_block3_selected", [])
-        if opt in sel:
-            sel.remove(opt)
-        else:
-            sel.append(opt)
-        context.user_data["deep_block3_selected"] = sel
-        options3 = ["Кежуал", "Спортивный", "Офисный (рубашка/пиджак)", "Уличный / streetwear",
-                    "Минимализм", "Творческий", "Гранж / рок", "Брутальный", "Аккуратный, ухоженный", "Не важно"]
-        try:
-            await query.edit_message_reply_markup(reply_markup=deep_multiselect_keyboard(options3, sel))
-        except Exception:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Обновлено.", reply_markup=deep_multiselect_keyboard(options3, sel))
-        return DEEP_BLOCK3
-
-    if data == "deep_next" and context.user_data.get("deep_block3_selected") is not None:
-        context.user_data["deep"]["block3"] = context.user_data.get("deep_block3_selected", [])
-        context.user_data.pop("deep_block3_selected", None)
-        options4 = ["Добрый", "Уверенный", "Спокойный", "Харизматичный", "Заботливый",
-                    "Дерзкий / хулиган", "Интеллектуальный", "Весёлый / лёгкий", "Серьёзный",
-                    "Интровертный", "Экстравертный"]
-        context.user_data["deep_block4_selected"] = []
-        await query.edit_message_text("Какой вайб (атмосфера) тебя привлекает больше всего?", reply_markup=deep_multiselect_keyboard(options4, []))
-        return DEEP_BLOCK4
-
-    # блок 4
-    if data.startswith("deep_toggle::") and context.user_data.get("deep_block4_selected") is not None:
-        opt = data.split("::", 1)[1]
-        sel = context.user_data.get("deep_block4_selected", [])
-        if opt in sel:
-            sel.remove(opt)
-        else:
-            sel.append(opt)
-        context.user_data["deep_block4_selected"] = sel
-        options4 = ["Добрый", "Уверенный", "Спокойный", "Харизматичный", "Заботливый",
-                    "Дерзкий / хулиган", "Интеллектуальный", "Весёлый / лёгкий", "Серьёзный",
-                    "Интровертный", "Экстравертный"]
-        try:
-            await query.edit_message_reply_markup(reply_markup=deep_multiselect_keyboard(options4, sel))
-        except Exception:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Обновлено.", reply_markup=deep_multiselect_keyboard(options4, sel))
-        return DEEP_BLOCK4
-
-    if data == "deep_next" and context.user_data.get("deep_block4_selected") is not None:
-        context.user_data["deep"]["block4"] = context.user_data.get("deep_block4_selected", [])
-        entry = {
-            "user_id": context.user_data.get("uid"),
-            "photo": context.user_data.get("current_photo"),
-            "rating": context.user_data.get("rating"),
-            "details": context.user_data.get("details", []),
-            "city": context.user_data.get("city"),
-            "deep": context.user_data.get("deep"),
-        }
-        save_result(entry)
-        await notify_admins(context, entry)
+    if block.then is None:
+        await complete_survey(update, context, deep=True)
         try:
             await query.edit_message_text("Спасибо!\nТвои ответы уйдут в «Самцыч» и помогут создать портрет идеального парня в твоём городе.",
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📊 Перейти в канал", url="https://t.me/sam_tich")]]))
+                                          reply_markup=CHANNEL_KEYBOARD)
         except Exception:
             pass
         return ConversationHandler.END
 
-    await query.answer("Неизвестная команда (deep).")
-    return DEEP_BLOCK1
+    nxt = BLOCKS[block.then]
+    context.user_data["deep_block"] = nxt.key
+    context.user_data["deep_mask"] = 0
+    await query.edit_message_text(nxt.prompt, reply_markup=nxt.keyboard())
+    remember_markup(query.message, nxt.keyboard())
+    return nxt.state
+
+async def deep_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: SurveyCallback):
+    block = cb.block
+    # одиночный выбор сразу ведёт дальше, мультивыбор — по кнопке «Дальше»
+    if not block.multi:
+        return await deep_advance(update, context, block, 1 << cb.option)
+    mask = context.user_data.get("deep_mask", 0) ^ (1 << cb.option)
+    context.user_data["deep_mask"] = mask
+    await update_markup(update, context, block.keyboard(mask))
+    return block.state
+
+async def deep_next(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: SurveyCallback):
+    return await deep_advance(update, context, cb.block, context.user_data.get("deep_mask", 0))
+
+DEEP_ACTIONS = {ACTION_TOGGLE: deep_toggle, ACTION_NEXT: deep_next}
+
+async def deep_toggle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Общий обработчик глубоких блоков: переключение варианта и переход по схеме опроса."""
+    query = update.callback_query
+    await query.answer()
+    cb = decode_callback(query.data)
+    if cb is None or cb.block.key != context.user_data.get("deep_block"):
+        await query.answer("Неизвестная команда (deep).")
+        return BLOCKS[context.user_data.get("deep_block", DEEP_FIRST_BLOCK)].state
+    return await DEEP_ACTIONS[cb.action](update, context, cb)
 
 async def notify_admins(context: ContextTypes.DEFAULT_TYPE, entry: dict):
-    text = (
-        f"Новый ответ:\n"
-        f"Пользователь ID: {entry.get('user_id')}\n\n"
-        f"Фото: {entry.get('photo')}\n"
-        f"Оценка: {entry.get('rating')}\n"
-        f"Детали: {', '.join(entry.get('details') or [])}\n"
-        f"Город: {entry.get('city')}\n"
-        f"Глубокие ответы: {json.dumps(entry.get('deep'), ensure_ascii=False)}"
-    )
+    if WORKER_SHARD is not None:
+        # в шардированном режиме админов уведомляет агрегатор, получив ответ
+        return
+    if admin_notifier.running:
+        admin_notifier.submit(entry)
+        return
+    text = "Новый ответ:\n" + format_admin_entry(entry)
     for admin in ADMIN_IDS:
         try:
             await context.bot.send_message(chat_id=admin, text=text)
         except Exception:
             logger.exception("Не удалось отправить админу %s", admin)
 
+def stats_text(args: List[str]) -> str:
+    if not args:
+        cities = sorted(portrait_stats.cities, key=lambda c: -portrait_stats.cities[c]["total"])
+        return "Использование: /stats <город>\nГорода: " + (", ".join(cities) or "—")
+    return portrait_stats.report(resolve_city(" ".join(args)))
+
+def top_text(args: List[str]) -> str:
+    args = list(args)
+    k = TOP_DEFAULT
+    if args and args[-1].isdigit():
+        k = max(1, min(int(args.pop()), TOP_MAX))
+    city = resolve_city(" ".join(args)) if args else ALL_CITIES
+    return photo_leaderboard.report(city, k)
+
+# отчёты по счётчикам; в шардированном запуске их считает и отправляет агрегатор
+ADMIN_REPORTS = {"stats": stats_text, "top": top_text}
+
+async def reply_report(update: Update, context: ContextTypes.DEFAULT_TYPE, name: str):
+    if not is_admin(update):
+        return
+    args = list(context.args or [])
+    if WORKER_SHARD is not None:
+        # у воркера счётчиков нет — запрос уходит агрегатору той же очередью, что и ответы
+        await asyncio.to_thread(shard_results.put, ("report", name, update.effective_chat.id,
+                                                    update.message.message_id, args))
+        return
+    await update.message.reply_text(ADMIN_REPORTS[name](args))
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats <город> — портрет по счётчикам, без чтения хранилища."""
+    await reply_report(update, context, "stats")
+
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/top [город] [k] — лучшие фото по оценке одобрения."""
+    await reply_report(update, context, "top")
+
+async def reload_photos_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/reload_photos — перечитать каталог фото без перезапуска."""
+    if not is_admin(update):
+        return
+    try:
+        await asyncio.to_thread(photo_catalogue.load)
+    except Exception as e:
+        logger.exception("Не удалось перечитать каталог фото")
+        await update.message.reply_text(f"Ошибка каталога: {e}")
+        return
+    await update.message.reply_text(f"Каталог перечитан: {len(photo_catalogue.photos)} фото.")
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [csv|parquet] [city=...] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] — выгрузка ответов документом."""
+    if not is_admin(update):
+        return
+    try:
+        options = parse_export_args(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\nИспользование: /export [csv|parquet] [city=Минск] [from=2024-01-01] [to=2024-01-31]")
+        return
+    await update.message.reply_text("Готовлю выгрузку…")
+    workdir = tempfile.mkdtemp(prefix="export_")
+    try:
+        paths = await asyncio.to_thread(export_results, os.path.join(workdir, "results"),
+                                        chunk_bytes=EXPORT_CHUNK_BYTES, **options)
+        for i, path in enumerate(paths, 1):
+            with open(path, "rb") as f:
+                await context.bot.send_document(
+                    chat_id=update.effective_chat.id, document=f, filename=os.path.basename(path),
+                    caption=f"Часть {i}/{len(paths)}" if len(paths) > 1 else None,
+                )
+    except Exception as e:
+        logger.exception("Экспорт не удался")
+        await update.message.reply_text(f"Экспорт не удался: {e}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/metrics — сводка задержек обработчиков и Bot API."""
+    if not is_admin(update):
+        return
+    text = metrics.summary()
+    for start_at in range(0, len(text), TELEGRAM_TEXT_LIMIT):
+        await update.message.reply_text(text[start_at:start_at + TELEGRAM_TEXT_LIMIT])
+
 async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message:
         await update.message.reply_text("Используй меню для начала или /start.")
@@ -492,6 +3276,170 @@ async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Команда не распознана. Используй /start чтобы начать.")
 
+# -------------------- Защита от флуда --------------------
+# Апдейт проходит через AbuseGuard раньше ConversationHandler (группа -1): лишнее отбрасывается до того,
+# как превратится в вызовы Bot API и записи в хранилище. Лимиты — токен-бакеты на пользователя и класс
+# действия; сколько раз пользователь может завершить опрос по одному фото — скользящее окно.
+THROTTLE_LIMITS = {
+    # класс: (токенов в секунду, не больше подряд)
+    "start": (1 / 10, 3),
+    "album": (1 / 15, 2),      # menu_rate: каждое нажатие — новый альбом
+    "survey": (3.0, 30),       # оценки, галочки, «Далее» — опрос проходится ~25 нажатиями
+    "text": (1.0, 5),
+    "command": (1 / 5, 5),
+}
+THROTTLE_USERS = 50_000        # сколько пользователей помним; дальше вытесняем давно молчавших
+THROTTLE_NOTICE_INTERVAL = 30  # предупреждаем о лимите не чаще раза в столько секунд
+COMPLETION_LIMIT = 2           # завершений на одно фото от одного пользователя
+COMPLETION_WINDOW = 24 * 3600
+COMPLETION_KEYS = 200_000
+
+
+class SlidingCounter:
+    """Скользящее окно в O(1) памяти: счёт текущего и прошлого отрезков, прошлый берётся с весом."""
+
+    __slots__ = ("window", "start", "previous", "current")
+
+    def __init__(self, window: float, now: float):
+        self.window = window
+        self.start = now
+        self.previous = 0
+        self.current = 0
+
+    def _roll(self, now: float):
+        passed = int((now - self.start) // self.window)
+        if passed:
+            self.previous = self.current if passed == 1 else 0
+            self.current = 0
+            self.start += passed * self.window
+
+    def count(self, now: float) -> float:
+        self._roll(now)
+        return self.previous * (1 - (now - self.start) / self.window) + self.current
+
+    def add(self, now: float):
+        self._roll(now)
+        self.current += 1
+
+    def expired(self, now: float) -> bool:
+        # оба отрезка позади — счётчик снова нулевой, хранить его незачем
+        return now - self.start >= 2 * self.window
+
+
+def action_class(update: Update) -> Optional[str]:
+    if update.callback_query is not None:
+        return "album" if update.callback_query.data == "menu_rate" else "survey"
+    message = update.effective_message
+    if message is None or not message.text:
+        return None
+    if message.text.startswith("/"):
+        return "start" if message.text.split()[0].split("@")[0] == "/start" else "command"
+    return "text"
+
+
+class AbuseGuard:
+    def __init__(self, limits: dict = THROTTLE_LIMITS, capacity: int = THROTTLE_USERS,
+                 completion_limit: int = COMPLETION_LIMIT, completion_window: float = COMPLETION_WINDOW,
+                 completion_capacity: int = COMPLETION_KEYS):
+        self.limits = limits
+        self.capacity = capacity
+        self.completion_limit = completion_limit
+        self.completion_window = completion_window
+        self.completion_capacity = completion_capacity
+        # user_id -> {класс: TokenBucket, "notice": когда последний раз предупреждали}
+        self._users = OrderedDict()
+        # (user_id, фото) -> SlidingCounter, от давно тронутых к свежим
+        self._completions = OrderedDict()
+        self.dropped = 0
+        self.capped = 0
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def _user(self, user_id: int) -> dict:
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = {"notice": 0.0}
+            if len(self._users) > self.capacity:
+                # у вытесненного бакеты давно полные — он ничего не теряет
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return state
+
+    def allow(self, user_id: int, action: str) -> bool:
+        state = self._user(user_id)
+        bucket = state.get(action)
+        if bucket is None:
+            bucket = state[action] = TokenBucket(*self.limits[action])
+        return bucket.try_take()
+
+    def should_notice(self, user_id: int) -> bool:
+        state = self._user(user_id)
+        now = time.monotonic()
+        if now - state["notice"] < THROTTLE_NOTICE_INTERVAL:
+            return False
+        state["notice"] = now
+        return True
+
+    def _counter(self, key, now: float, create: bool) -> Optional[SlidingCounter]:
+        # заодно выбрасываем истёкшие счётчики с «холодного» конца
+        while self._completions:
+            oldest = next(iter(self._completions.values()))
+            if not oldest.expired(now) and len(self._completions) <= self.completion_capacity:
+                break
+            self._completions.popitem(last=False)
+        counter = self._completions.get(key)
+        if counter is None and create:
+            counter = self._completions[key] = SlidingCounter(self.completion_window, now)
+        if counter is not None:
+            self._completions.move_to_end(key)
+        return counter
+
+    def completion_capped(self, user_id: int, photo) -> bool:
+        now = time.time()
+        counter = self._counter((user_id, photo), now, create=False)
+        return counter is not None and counter.count(now) >= self.completion_limit
+
+    def record_completion(self, user_id: int, photo) -> bool:
+        """Засчитывает завершение; False — лимит по этому фото уже выбран, ответ не пишем."""
+        now = time.time()
+        counter = self._counter((user_id, photo), now, create=True)
+        if counter.count(now) >= self.completion_limit:
+            self.capped += 1
+            return False
+        counter.add(now)
+        return True
+
+
+abuse_guard = AbuseGuard()
+
+
+async def guard_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группа -1: пропускает апдейт дальше или останавливает его обработку."""
+    user = update.effective_user
+    action = action_class(update)
+    if user is None or action is None or is_admin(update):
+        return
+    query = update.callback_query
+    if not abuse_guard.allow(user.id, action):
+        abuse_guard.dropped += 1
+        metrics.inc("updates_throttled_total", action=action)
+        if abuse_guard.should_notice(user.id):
+            # одно предупреждение, а не ответ на каждое нажатие — иначе флуд всё равно тратит квоту
+            if query is not None:
+                await query.answer("Слишком часто, подожди немного.")
+            elif update.effective_message is not None:
+                await update.effective_message.reply_text("Слишком часто, подожди немного.")
+        raise ApplicationHandlerStop
+    if query is not None and query.data in RATINGS and context.user_data is not None:
+        photo = context.user_data.get("current_photo")
+        if photo is not None and abuse_guard.completion_capped(user.id, photo):
+            metrics.inc("updates_throttled_total", action="completion")
+            await query.answer("Это фото ты уже оценивал(а). Нажми /start, чтобы взять другое.", show_alert=True)
+            raise ApplicationHandlerStop
+
+
 # -------------------- ConversationHandler --------------------
 def build_conv_handler():
     conv = ConversationHandler(
@@ -499,39 +3447,651 @@ def build_conv_handler():
         states={
             START_MENU: [CallbackQueryHandler(menu_callback, pattern=r"^menu_")],
             RATE_PHOTO: [CallbackQueryHandler(rating_callback, pattern=r"^rate_")],
-            AFTER_RATING: [CallbackQueryHandler(details_toggle_callback, pattern=r"^(toggle::|details_next)")],
-            CITY_CHOICE: [CallbackQueryHandler(city_callback, pattern=r"^city::")],
+            AFTER_RATING: [CallbackQueryHandler(details_toggle_callback, pattern=survey_pattern("P", "N"))],
+            CITY_CHOICE: [CallbackQueryHandler(city_callback, pattern=survey_pattern("C"))],
             OTHER_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, other_city_text)],
             INVITE_DEEP: [CallbackQueryHandler(invite_callback, pattern=r"^invite_")],
-            DEEP_BLOCK1: [CallbackQueryHandler(deep_toggle_callback, pattern=r"^(deep_toggle::|deep_next)")],
-            DEEP_BLOCK2: [CallbackQueryHandler(deep_toggle_callback, pattern=r"^deep2::")],
-            DEEP_BLOCK3: [CallbackQueryHandler(deep_toggle_callback, pattern=r"^(deep_toggle::|deep_next)")],
-            DEEP_BLOCK4: [CallbackQueryHandler(deep_toggle_callback, pattern=r"^(deep_toggle::|deep_next)")],
+            DEEP_BLOCK1: [CallbackQueryHandler(deep_toggle_callback, pattern=survey_pattern("1"))],
+            DEEP_BLOCK2: [CallbackQueryHandler(deep_toggle_callback, pattern=survey_pattern("2"))],
+            DEEP_BLOCK3: [CallbackQueryHandler(deep_toggle_callback, pattern=survey_pattern("3"))],
+            DEEP_BLOCK4: [CallbackQueryHandler(deep_toggle_callback, pattern=survey_pattern("4"))],
         },
         fallbacks=[CommandHandler("start", start), MessageHandler(filters.TEXT & ~filters.COMMAND, fallback)],
         allow_reentry=True,
-        persistent=False,
+        name="survey",
+        persistent=True,
         per_chat=True,  # important: track conversation per chat so callbacks + messages both work
     )
     return conv
 
+# -------------------- Параллельная обработка и webhook --------------------
+# сколько апдейтов обрабатываем одновременно; апдейты одного чата всё равно идут по очереди
+UPDATE_CONCURRENCY = 64
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_MAX_BODY = 1 << 20
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельно по разным чатам, строго по порядку внутри одного чата."""
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        # общий лимит — приватный семафор базового класса (PTB 22.x): по нему же считается
+        # current_concurrent_updates, свой семафор это сломал бы. Обращаемся к нему только здесь,
+        # чтобы при обновлении python-telegram-bot ошибка была при запуске, а не на первом апдейте
+        self._slots = self._semaphore
+        self._chats = {}
+
+    @staticmethod
+    def _chat_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return update.effective_user.id
+        return None
+
+    async def process_update(self, update: object, coroutine):
+        # базовый класс берёт общий слот до do_process_update — тогда апдейты, ждущие свой чат, держали бы
+        # слоты, и один частящий чат тормозил бы все остальные; поэтому слот берём уже под lock'ом чата.
+        # В PTB process_update помечен @final — переопределение тоже сверять при обновлении
+        await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update: object, coroutine):
+        key = self._chat_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        # [lock, сколько апдейтов чата ждут/выполняются] — запись живёт, пока есть очередь
+        slot = self._chats.get(key)
+        if slot is None:
+            slot = self._chats[key] = [asyncio.Lock(), 0]
+        slot[1] += 1
+        try:
+            async with slot[0], self._slots:
+                await coroutine
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self._chats[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 503: "Service Unavailable"}
+# сервер смотрит в интернет: молчащие и медленные (slowloris) соединения не должны копиться
+HTTP_IDLE_TIMEOUT = 30         # ожидание следующего запроса в keep-alive соединении
+HTTP_REQUEST_TIMEOUT = 10      # на заголовки и тело одного запроса
+HTTP_MAX_CONNECTIONS = 256
+HTTP_MAX_HEADERS = 100
+
+
+class HttpServer:
+    """Минимальный HTTP/1.1-сервер на asyncio: маршруты (метод, путь) -> async handler(body) -> (код, тип, тело)."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.connections = 0
+        self.rejected = 0
+
+    def route(self, method: str, path: str, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # при port=0 система выбирает свободный порт
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("HTTP-сервер слушает %s:%d", self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader: asyncio.StreamReader, request_line: bytes):
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= HTTP_MAX_HEADERS:
+                raise ValueError("слишком много заголовков")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length > WEBHOOK_MAX_BODY:
+            return method, target, headers, None
+        payload = await reader.readexactly(length) if length else b""
+        return method, target, headers, payload
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self.connections >= HTTP_MAX_CONNECTIONS:
+            self.rejected += 1
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            writer.close()
+            return
+        self.connections += 1
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+                if not request_line:
+                    break
+                method, target, headers, payload = await asyncio.wait_for(
+                    self._read_request(reader, request_line), HTTP_REQUEST_TIMEOUT)
+                if payload is None:
+                    status, ctype, body = 413, "text/plain", b""
+                else:
+                    path = target.split("?", 1)[0]
+                    handler = self.routes.get((method, path))
+                    if handler is None:
+                        known = any(p == path for _, p in self.routes)
+                        status, ctype, body = (405 if known else 404), "text/plain", b""
+                    else:
+                        status, ctype, body = await handler(payload, headers)
+                keep_alive = headers.get("connection", "").lower() != "close" and status != 413
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                    f"Content-Type: {ctype}\r\nContent-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+                )
+                await asyncio.wait_for(writer.drain(), HTTP_REQUEST_TIMEOUT)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+
+def webhook_handler(app, secret_token: Optional[str]):
+    async def handle(payload: bytes, headers: dict):
+        if secret_token and headers.get("x-telegram-bot-api-secret-token") != secret_token:
+            return 403, "text/plain", b""
+        try:
+            update = Update.de_json(json.loads(payload), app.bot)
+        except Exception:
+            logger.warning("Webhook: не удалось разобрать апдейт")
+            return 400, "text/plain", b""
+        # отвечаем Telegram сразу, обработка идёт через очередь приложения
+        await app.update_queue.put(update)
+        return 200, "text/plain", b""
+    return handle
+
+
+async def serve_webhook(app, url: Optional[str], host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+                        path: str = WEBHOOK_PATH, secret_token: Optional[str] = None, stop_event: Optional[asyncio.Event] = None):
+    """Жизненный цикл приложения в режиме webhook на собственном HTTP-сервере."""
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    server = HttpServer(host, port)
+    server.route("POST", path, webhook_handler(app, secret_token))
+    await app.initialize()
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        await server.start()
+        if url:
+            await app.bot.set_webhook(url=url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+        await app.start()
+        logger.info("Бот запущен (webhook)!")
+        await stop_event.wait()
+        await server.stop()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+    finally:
+        await server.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+# -------------------- Шардированный запуск --------------------
+# Фронт принимает апдейты и раскладывает их по воркерам по chat_id: апдейты одного чата всегда
+# попадают в один воркер и обрабатываются там по очереди. Воркеры отдают готовые ответы агрегатору —
+# единственному процессу, который пишет хранилище, ведёт статистику и уведомляет админов.
+# Состояние диалогов у каждого шарда своё: при смене числа шардов незаконченные опросы начнутся заново.
+SHARD_QUEUE_SIZE = 10_000
+SHARD_POLL_TIMEOUT = 30
+# глобальные настройки, которые передаём в процессы (они стартуют через spawn и импортируют модуль заново)
+SHARD_CONFIG = ("BOT_TOKEN", "DATA_FILE", "ADMIN_IDS", "PHOTO_IDS", "RESULTS_BACKEND",
+                "PHOTO_CATALOGUE_FILE", "PHOTO_FILE_ID_CACHE", "GAZETTEER_FILE", "METRICS_HOST")
+# номер шарда в процессе-воркере; None — обычный запуск одним процессом
+WORKER_SHARD: Optional[int] = None
+# у воркера: очередь к агрегатору (пачки ответов и запросы отчётов)
+shard_results = None
+
+
+def shard_config() -> dict:
+    return {name: globals()[name] for name in SHARD_CONFIG if name in globals()}
+
+
+def apply_shard_config(config: dict):
+    global photo_catalogue
+    globals().update(config)
+    stem, ext = os.path.splitext(PHOTO_FILE_ID_CACHE)
+    # воркеры не пишут в один и тот же файл: у каждого шарда свой кэш поверх общего
+    photo_catalogue = PhotoCatalogue(PHOTO_CATALOGUE_FILE, stem + shard_suffix() + ext, shared_cache_path=PHOTO_FILE_ID_CACHE)
+
+
+def shard_of(payload: dict, shards: int) -> int:
+    # тот же ключ, что у PerChatUpdateProcessor: чат, а если его нет — пользователь
+    for value in payload.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"] % shards
+        user = value.get("from")
+        if user:
+            return user["id"] % shards
+    return 0
+
+
+def make_bot_request(request_factory=None) -> BaseRequest:
+    return request_factory() if request_factory is not None else HTTPXRequest()
+
+
+def run_shard_worker(shard: int, config: dict, updates, results, ready, request_factory=None,
+                     concurrency: int = UPDATE_CONCURRENCY, metrics_port: Optional[int] = None):
+    global WORKER_SHARD, shard_results
+    WORKER_SHARD = shard
+    shard_results = results
+    apply_shard_config(config)
+    # ответы уходят агрегатору пачками; статистику здесь не ведём
+    result_writer.sink = results.put
+    result_writer.listeners.clear()
+    asyncio.run(_shard_worker(updates, ready, request_factory, concurrency, metrics_port))
+
+
+async def _shard_worker(updates, ready, request_factory, concurrency: int, metrics_port: Optional[int]):
+    app = build_application(request=make_bot_request(request_factory), concurrency=concurrency)
+    if metrics_port is not None:
+        app.bot_data["metrics_port"] = metrics_port + 1 + WORKER_SHARD
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    ready.set()
+    running = True
+    while running:
+        # фронт кладёт списки апдейтов; забираем всё, что накопилось, одним заходом в поток
+        batches = await asyncio.to_thread(_drain_queue, updates)
+        for batch in batches:
+            if batch is None:
+                running = False
+                break
+            for payload in batch:
+                await app.update_queue.put(Update.de_json(payload, app.bot))
+    # всё, что уже пришло, должно попасть в обработку до остановки
+    await app.update_queue.join()
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+
+
+def _drain_queue(q) -> list:
+    items = [q.get()]
+    while items[-1] is not None:
+        try:
+            items.append(q.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+
+async def _send_report(bot, name: str, chat_id: int, message_id: int, args: List[str]):
+    try:
+        await bot.send_message(chat_id=chat_id, text=ADMIN_REPORTS[name](args), reply_to_message_id=message_id)
+    except Exception:
+        logger.exception("Не удалось отправить отчёт /%s в чат %s", name, chat_id)
+
+
+def run_shard_aggregator(config: dict, results, ready, request_factory=None):
+    apply_shard_config(config)
+    asyncio.run(_shard_aggregator(results, ready, request_factory))
+
+
+async def _shard_aggregator(results, ready, request_factory):
+    bot = Bot(BOT_TOKEN, request=InstrumentedRequest(make_bot_request(request_factory)))
+    await bot.initialize()
+    await asyncio.to_thread(load_stats)
+    result_writer.start()
+    admin_notifier.start(bot)
+    ready.set()
+    replies = set()
+    running = True
+    while running:
+        for batch in await asyncio.to_thread(_drain_queue, results):
+            if batch is None:
+                running = False
+                break
+            if isinstance(batch, tuple):
+                # ("report", имя, chat_id, message_id, args) — /stats или /top, пришедшие воркеру
+                task = asyncio.create_task(_send_report(bot, *batch[1:]))
+                replies.add(task)
+                task.add_done_callback(replies.discard)
+                continue
+            for entry in batch:
+                await result_writer.put(entry)
+                admin_notifier.submit(entry)
+    if replies:
+        await asyncio.wait(replies)
+    await admin_notifier.stop()
+    await result_writer.stop()
+    await asyncio.to_thread(write_file_atomic, stats_snapshot_path(), portrait_stats.snapshot())
+    get_results_store().close()
+    await bot.shutdown()
+
+
+class ShardRouter:
+    """Процессы шардированного запуска: агрегатор, N воркеров и раскладка апдейтов по ним."""
+
+    def __init__(self, shards: int, concurrency: int = UPDATE_CONCURRENCY, request_factory=None,
+                 metrics_port: Optional[int] = None):
+        ctx = multiprocessing.get_context("spawn")
+        config = shard_config()
+        self.shards = shards
+        self.results = ctx.Queue(SHARD_QUEUE_SIZE)
+        self.queues = [ctx.Queue(SHARD_QUEUE_SIZE) for _ in range(shards)]
+        self._ready = [ctx.Event() for _ in range(shards + 1)]
+        self.aggregator = ctx.Process(target=run_shard_aggregator, name="aggregator",
+                                      args=(config, self.results, self._ready[0], request_factory))
+        self.workers = [
+            ctx.Process(target=run_shard_worker, name=f"shard{i}",
+                        args=(i, config, q, self.results, self._ready[i + 1], request_factory, concurrency, metrics_port))
+            for i, q in enumerate(self.queues)
+        ]
+        self.dispatched = 0
+
+    def start(self, timeout: float = 60):
+        # агрегатор первым: он открывает (и при необходимости переносит) хранилище
+        self.aggregator.start()
+        self._wait_ready(self._ready[0], self.aggregator, timeout)
+        for worker, ready in zip(self.workers, self._ready[1:]):
+            worker.start()
+        for worker, ready in zip(self.workers, self._ready[1:]):
+            self._wait_ready(ready, worker, timeout)
+        logger.info("Шардированный запуск: %d воркеров и агрегатор", self.shards)
+
+    @staticmethod
+    def _wait_ready(ready, process, timeout: float):
+        deadline = time.monotonic() + timeout
+        while not ready.wait(0.5):
+            if not process.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError(f"Процесс {process.name} не запустился")
+
+    def dispatch(self, payloads: List[dict]):
+        # порядок внутри шарда сохраняется: одна очередь, один писатель
+        by_shard = {}
+        for payload in payloads:
+            by_shard.setdefault(shard_of(payload, self.shards), []).append(payload)
+        for shard, batch in by_shard.items():
+            self.queues[shard].put(batch)
+        self.dispatched += len(payloads)
+
+    def stop(self):
+        # воркеры дорабатывают свои очереди и сбрасывают ответы, потом останавливается агрегатор
+        for q in self.queues:
+            q.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.results.put(None)
+        self.aggregator.join()
+
+
+async def poll_shards(router: ShardRouter, stop_event: asyncio.Event, request_factory=None):
+    """Long polling во фронте: апдейты не разбираем в объекты, а сразу раскладываем по шардам."""
+    # сырой getUpdates нужен намеренно — PTB об этом предупреждает
+    warnings.filterwarnings("ignore", message=".*do_api_request", category=PTBUserWarning)
+    bot = Bot(BOT_TOKEN, request=make_bot_request(request_factory), get_updates_request=make_bot_request(request_factory))
+    offset = None
+    async with bot:
+        while not stop_event.is_set():
+            kwargs = {"timeout": SHARD_POLL_TIMEOUT, "allowed_updates": Update.ALL_TYPES}
+            if offset is not None:
+                kwargs["offset"] = offset
+            poll = asyncio.ensure_future(bot.do_api_request("getUpdates", api_kwargs=kwargs,
+                                                            read_timeout=SHARD_POLL_TIMEOUT + 10))
+            stop = asyncio.ensure_future(stop_event.wait())
+            await asyncio.wait((poll, stop), return_when=asyncio.FIRST_COMPLETED)
+            stop.cancel()
+            if not poll.done():
+                poll.cancel()
+                break
+            try:
+                payloads = poll.result()
+            except (NetworkError, TimedOut):
+                logger.warning("getUpdates не удался, повторяем")
+                await asyncio.sleep(1)
+                continue
+            if payloads:
+                offset = payloads[-1]["update_id"] + 1
+                router.dispatch(payloads)
+
+
+def shard_webhook_handler(router: ShardRouter, secret_token: Optional[str]):
+    async def handle(payload: bytes, headers: dict):
+        if secret_token and headers.get("x-telegram-bot-api-secret-token") != secret_token:
+            return 403, "text/plain", b""
+        try:
+            update = json.loads(payload)
+        except ValueError:
+            logger.warning("Webhook: не удалось разобрать апдейт")
+            return 400, "text/plain", b""
+        router.dispatch([update])
+        return 200, "text/plain", b""
+    return handle
+
+
+async def serve_shards(router: ShardRouter, args, request_factory=None, stop_event: Optional[asyncio.Event] = None):
+    """Фронт шардированного запуска: webhook или long polling до сигнала остановки."""
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    if not args.webhook:
+        logger.info("Бот запущен (polling, %d шардов)!", router.shards)
+        await poll_shards(router, stop_event, request_factory)
+        return
+    server = HttpServer(args.host, args.port)
+    server.route("POST", args.path, shard_webhook_handler(router, args.secret_token))
+    await server.start()
+    try:
+        if args.webhook_url:
+            async with Bot(BOT_TOKEN, request=make_bot_request(request_factory)) as bot:
+                await bot.set_webhook(url=args.webhook_url, secret_token=args.secret_token,
+                                      allowed_updates=Update.ALL_TYPES)
+        logger.info("Бот запущен (webhook, %d шардов)!", router.shards)
+        await stop_event.wait()
+    finally:
+        await server.stop()
+
+
+def run_sharded(args):
+    global METRICS_HOST
+    # воркеры получают адрес слушателя метрик вместе с остальной конфигурацией
+    METRICS_HOST = args.metrics_host
+    router = ShardRouter(args.shards, concurrency=args.concurrency, metrics_port=args.metrics_port)
+    router.start()
+    try:
+        asyncio.run(serve_shards(router, args))
+    finally:
+        router.stop()
+
+
 # -------------------- Main --------------------
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+async def metrics_endpoint(payload: bytes, headers: dict):
+    return 200, "text/plain; version=0.0.4", metrics.render().encode("utf-8")
+
+def register_gauges(app, persistence: SurveyPersistence):
+    def conversations():
+        counts = {}
+        for state in persistence.live.values():
+            key = (("state", STATE_NAMES.get(state, state)),)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+    metrics.gauge("conversations_live", conversations, "незаконченные диалоги по состояниям")
+    metrics.gauge("write_queue_depth", lambda: result_writer.depth)
+    metrics.gauge("results_written", lambda: result_writer.written)
+    metrics.gauge("write_backpressure_waits", lambda: result_writer.backpressure_waits)
+    metrics.gauge("keyboard_edits_saved", lambda: markup_edits.saved)
+    metrics.gauge("duplicate_completions_dropped", lambda: completion_index.duplicates)
+    metrics.gauge("throttled_users_tracked", lambda: len(abuse_guard))
+    metrics.gauge("completions_over_limit", lambda: abuse_guard.capped)
+    metrics.gauge("admin_notifications_delivered", lambda: admin_notifier.delivered)
+    metrics.gauge("admin_notifications_dropped", lambda: admin_notifier.dropped)
+    metrics.gauge("user_data_cached", lambda: len(app.user_data))
+
+async def post_init(app):
+    await asyncio.to_thread(photo_catalogue.load)
+    await asyncio.to_thread(city_resolver.load)
+    if WORKER_SHARD is None:
+        # у воркера шарда этим занимается агрегатор
+        await asyncio.to_thread(load_stats)
+        admin_notifier.start(app.bot)
+    await asyncio.to_thread(completion_index.load, completion_index_path())
+    result_writer.start()
+    app.bot_data["sweeper"] = asyncio.create_task(sweep_sessions(app), name="sweep_sessions")
+    if app.bot_data.get("metrics_port") is not None:
+        # метрики отдаёт отдельный маленький HTTP-сервер, а не тот, что принимает webhook из интернета
+        server = app.bot_data["metrics_server"] = HttpServer(app.bot_data.get("metrics_host", METRICS_HOST),
+                                                             app.bot_data["metrics_port"])
+        server.route("GET", "/metrics", metrics_endpoint)
+        await server.start()
+
+async def post_stop(app):
+    app.bot_data["sweeper"].cancel()
+    if "metrics_server" in app.bot_data:
+        await app.bot_data.pop("metrics_server").stop()
+    # бот ещё жив — успеваем разослать накопленное админам
+    markup_edits.close()
+    await admin_notifier.stop()
+
+async def post_shutdown(app):
+    await completion_index.close()
+    await result_writer.stop()
+    if WORKER_SHARD is not None:
+        return
+    await asyncio.to_thread(write_file_atomic, stats_snapshot_path(), portrait_stats.snapshot())
+    get_results_store().close()
+
+def build_application(request=None, concurrency: int = UPDATE_CONCURRENCY):
+    persistence = SurveyPersistence(state_file_path())
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .persistence(persistence)
+        .concurrent_updates(PerChatUpdateProcessor(concurrency))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if request is not None:
+        # подмена Bot API (например, фейковым сервером в тестах нагрузки)
+        builder = builder.get_updates_request(request)
+    # long polling (getUpdates) не оборачиваем — его «задержка» это ожидание апдейтов
+    builder = builder.request(InstrumentedRequest(request or HTTPXRequest()))
+    app = builder.build()
+    # до любых других обработчиков: флуд отсекается, не доходя до диалога
+    app.add_handler(TypeHandler(Update, guard_update), group=-1)
     conv = build_conv_handler()
     app.add_handler(conv)
     # Этот хендлер ставим ВЫШЕ ConversationHandler,
 # чтобы он всегда ловил фото
     app.add_handler(MessageHandler(filters.PHOTO, debug_photo))
     app.add_handler(CommandHandler("start", start))  # extra safety
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CommandHandler("top", top_command))
+    app.add_handler(CommandHandler("reload_photos", reload_photos_command))
+    app.add_handler(CommandHandler("export", export_command))
+    app.add_handler(CommandHandler("metrics", metrics_command))
     # глобальный ловец неожиданных callback'ов — полезно для отладки
     async def global_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.callback_query:
-            logger.info("GLOBAL callback: %s", update.callback_query.data)
+            logger.debug("GLOBAL callback: %s", update.callback_query.data)
             await update.callback_query.answer()
     app.add_handler(CallbackQueryHandler(global_cb))
     app.add_handler(MessageHandler(filters.COMMAND, unknown))
+    instrument_handlers(itertools.chain.from_iterable(app.handlers.values()))
+    register_gauges(app, persistence)
+    return app
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Бот «Самцыч»")
+    parser.add_argument("--webhook", action="store_true", help="принимать апдейты по webhook вместо long polling")
+    parser.add_argument("--webhook-url", help="публичный URL, который регистрируем в Telegram")
+    parser.add_argument("--host", default=WEBHOOK_HOST)
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT)
+    parser.add_argument("--path", default=WEBHOOK_PATH)
+    parser.add_argument("--secret-token", help="секрет для заголовка X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument("--concurrency", type=int, default=UPDATE_CONCURRENCY, help="сколько апдейтов обрабатывать параллельно")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="порт для GET /metrics (отдельный слушатель)")
+    parser.add_argument("--metrics-host", default=METRICS_HOST, help="адрес слушателя /metrics")
+    parser.add_argument("--shards", type=int, default=1, help="число процессов-воркеров (больше 1 — шардированный запуск)")
+    commands = parser.add_subparsers(dest="command")
+    export = commands.add_parser("export", help="выгрузить ответы в CSV/Parquet")
+    export.add_argument("-o", "--output", default="results", help="путь к файлу (расширение добавится)")
+    export.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    export.add_argument("--city")
+    export.add_argument("--since", help="с даты (ГГГГ-ММ-ДД, UTC)")
+    export.add_argument("--until", help="по дату включительно (ГГГГ-ММ-ДД, UTC)")
+    export.add_argument("--chunk-mb", type=int, help="резать на части примерно такого размера")
+    commands.add_parser("compact", help="переписать журнал ответов в компактный формат (при остановленном боте)")
+    batch = commands.add_parser("reaggregate", help="пересчитать портрет по всей истории (нужен numpy)")
+    batch.add_argument("--city")
+    batch.add_argument("--workers", type=int, default=0, help="считать города в пуле из N процессов")
+    batch.add_argument("-o", "--output", help="записать кросс-таблицы и матрицы совместного выбора в JSON")
+    batch.add_argument("--snapshot", action="store_true", help="заменить снимок статистики бота пересчитанным")
+    args = parser.parse_args(argv)
+
+    if args.command == "reaggregate":
+        print(reaggregate(args.city, workers=args.workers, output=args.output, snapshot=args.snapshot))
+        return
+
+    if args.command == "compact":
+        compact_results()
+        return
+
+    if args.command == "export":
+        paths = export_results(args.output, args.format, city=args.city, since=args.since, until=args.until,
+                               chunk_bytes=args.chunk_mb * 1024 * 1024 if args.chunk_mb else None)
+        print("\n".join(paths))
+        return
+
+    if args.shards > 1:
+        run_sharded(args)
+        return
 
+    app = build_application(concurrency=args.concurrency)
+    app.bot_data["metrics_port"] = args.metrics_port
+    app.bot_data["metrics_host"] = args.metrics_host
+    if args.webhook:
+        asyncio.run(serve_webhook(app, args.webhook_url, host=args.host, port=args.port,
+                                  path=args.path, secret_token=args.secret_token))
+        return
     logger.info("Бот запущен!")
     app.run_polling()
 